@@ -0,0 +1,292 @@
+"""Benchmark of tax.py stages on generated statements, without network.
+
+python benchmark.py --lines 100000 --tickers 200
+"""
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tax
+
+STATEMENT_START_DATE = date(2019, 1, 2)
+TRADES_PER_DAY = 50  # statement covers as many business days as needed for given number of lines
+SELL_PROBABILITY = 0.35
+DIV_PROBABILITY = 0.05
+DIVNRA_PROBABILITY = 0.02
+NBP_RATES_RE = re.compile(r'/rates/A/(?P<code>\w+)/(?P<start>\d{4}-\d\d-\d\d)/(?:(?P<end>\d{4}-\d\d-\d\d)/)?$')
+NBP_TABLES_RE = re.compile(r'/tables/A/(?P<start>\d{4}-\d\d-\d\d)/(?:(?P<end>\d{4}-\d\d-\d\d)/)?$')
+NBP_CURRENCIES = {
+    'USD': 3.8,
+    'EUR': 4.3,
+    'GBP': 4.9,
+}
+
+
+def get_business_days(start_date):
+    current_date = start_date
+    while True:
+        if current_date.weekday() < 5:
+            yield current_date
+        current_date += timedelta(days=1)
+
+
+def get_statement_line(trade_date, transaction_type, ticker, quantity, price, amount, currency='USD'):
+    trade_date = trade_date.strftime('%m/%d/%Y')
+    name = f'{ticker} - {ticker} HOLDINGS INC COM'
+    if transaction_type in ('DIV', 'DIVNRA'):
+        return f'{trade_date} {trade_date} {currency} {transaction_type} {name} - {transaction_type} {ticker} 0 0 {amount}\n'
+    side = 'B' if transaction_type == 'BUY' else 'S'
+    return (
+        f'{trade_date} {trade_date} {currency} {transaction_type} {name} - TRD {ticker} {side} {quantity.lstrip("-")} at {price} Principal. '
+        f'{quantity} {price} {amount}\n'
+    )
+
+
+def get_split_trades(split_tickers):
+    """[(date, order, ticker, action, ratio), ...] sorted by date, for every split of split_tickers in tax.STOCK_SPLITS:
+    buy on the last business day before the split, split itself, taking effect after its date like in
+    tax.CorporateActions, and sell of half of stocks held on the first business day after it (buy when none are held).
+    """
+    split_trades = []
+    for ticker, split_date, new_shares, old_shares in tax.STOCK_SPLITS:
+        if ticker not in split_tickers:
+            continue
+        split_date = date.fromisoformat(split_date)
+        buy_date = split_date - timedelta(days=1)
+        while buy_date.weekday() >= 5:
+            buy_date -= timedelta(days=1)
+        sell_date = next(get_business_days(split_date + timedelta(days=1)))
+        split_trades.append((buy_date, 0, ticker, 'BUY', None))
+        split_trades.append((split_date + timedelta(days=1), 1, ticker, 'SPLIT', new_shares / old_shares))
+        split_trades.append((sell_date, 2, ticker, 'SELL', None))
+    split_trades.sort()
+    return split_trades
+
+
+def write_statement(filename, lines, tickers=100, fractional=True, dividends=True, split_tickers=None, seed=0, currencies=('USD',)):
+    """Statement in format read by tax.get_parsed_data_line, written line by line so it can be huge.
+    Trades are in chronological order, sells never exceed stocks held.
+    split_tickers are traded at random like other tickers, and on both sides of each of their splits
+    from tax.STOCK_SPLITS, see get_split_trades, also when the split is outside of dates of random trades.
+    Every ticker is traded in one of currencies, split tickers in the first one.
+    """
+    randomizer = random.Random(seed)
+    split_tickers = list(split_tickers or [])
+    ticker_names = [f'T{index:05d}' for index in range(tickers - len(split_tickers))] + split_tickers
+    held = dict.fromkeys(ticker_names, 0)
+    ticker_currencies = {ticker: currencies[index % len(currencies)] for index, ticker in enumerate(ticker_names)}
+    ticker_currencies.update(dict.fromkeys(split_tickers, currencies[0]))
+    split_trades = get_split_trades(split_tickers)
+    business_days = get_business_days(STATEMENT_START_DATE)
+    trade_date = next(business_days)
+
+    def write_trade(file, trade_date, ticker, quantity=None, sell=False):
+        price = randomizer.uniform(1, 1500)
+        if quantity is None:
+            quantity = randomizer.randint(1, 2000000000) / 10 ** 8 if fractional else randomizer.randint(1, 100)
+        if sell:
+            quantity = min(quantity, held[ticker])
+            held[ticker] = round(held[ticker] - quantity, 8)
+            quantity_text = f'-{quantity:.8f}' if fractional else f'-{quantity}'
+        else:
+            held[ticker] = round(held[ticker] + quantity, 8)
+            quantity_text = f'{quantity:.8f}' if fractional else f'{quantity}'
+        file.write(get_statement_line(
+            trade_date, 'SELL' if sell else 'BUY', ticker, quantity_text, f'{price:.2f}', f'{quantity * price:,.2f}',
+            ticker_currencies[ticker],
+        ))
+
+    def write_split_trades(file, until_date):
+        while split_trades and split_trades[0][0] <= until_date:
+            split_trade_date, _, ticker, action, ratio = split_trades.pop(0)
+            if action == 'SPLIT':
+                held[ticker] = round(held[ticker] * ratio, 8) if fractional else int(held[ticker] * ratio)
+            elif action == 'SELL' and held[ticker] > 0:
+                write_trade(file, split_trade_date, ticker, round(held[ticker] / 2, 8) if fractional else held[ticker] // 2 or 1, sell=True)
+            else:
+                write_trade(file, split_trade_date, ticker)
+
+    with open(filename, 'w', buffering=1024 * 1024) as file:
+        for line_number in range(max(lines - sum(action != 'SPLIT' for _, _, _, action, _ in split_trades), 0)):
+            if line_number and line_number % TRADES_PER_DAY == 0:
+                trade_date = next(business_days)
+            write_split_trades(file, trade_date)
+            ticker = randomizer.choice(ticker_names)
+            draw = randomizer.random()
+            if dividends and draw < DIVNRA_PROBABILITY and held[ticker]:
+                amount = f'({randomizer.uniform(0.01, 5):.2f})'
+                file.write(get_statement_line(trade_date, 'DIVNRA', ticker, '0', '0', amount, ticker_currencies[ticker]))
+                continue
+            if dividends and draw < DIV_PROBABILITY and held[ticker]:
+                amount = f'{randomizer.uniform(0.1, 50):.2f}'
+                file.write(get_statement_line(trade_date, 'DIV', ticker, '0', '0', amount, ticker_currencies[ticker]))
+                continue
+            write_trade(file, trade_date, ticker, sell=draw < SELL_PROBABILITY and held[ticker] > 0)
+        if split_trades:
+            trade_date = max(trade_date, split_trades[-1][0])
+            write_split_trades(file, trade_date)
+    return trade_date
+
+
+def get_nbp_rate(currency, effective_date):
+    """Deterministic mid rate, with 4 decimal places like in real tables"""
+    return round(NBP_CURRENCIES[currency] + (effective_date.toordinal() * 7919 % 5000) / 10000, 4)
+
+
+def get_nbp_dates(start, end):
+    current_date = date.fromisoformat(start)
+    end_date = date.fromisoformat(end or start)
+    while current_date <= end_date:
+        if current_date.weekday() < 5:
+            yield current_date
+        current_date += timedelta(days=1)
+
+
+class NbpHandler(BaseHTTPRequestHandler):
+    """Answers rates and tables queries of api.nbp.pl with generated rates, weekends have no table"""
+    requests_count = 0
+
+    def do_GET(self):
+        NbpHandler.requests_count += 1
+        rates_match = NBP_RATES_RE.search(self.path)
+        tables_match = NBP_TABLES_RE.search(self.path)
+        payload = None
+        if rates_match and rates_match.group('code').upper() in NBP_CURRENCIES:
+            currency = rates_match.group('code').upper()
+            rates = [
+                {'no': f'{index}/A/NBP', 'effectiveDate': effective_date.isoformat(), 'mid': get_nbp_rate(currency, effective_date)}
+                for index, effective_date in enumerate(get_nbp_dates(rates_match.group('start'), rates_match.group('end')))
+            ]
+            if rates:
+                payload = {'table': 'A', 'currency': currency, 'code': currency, 'rates': rates}
+        elif tables_match:
+            payload = [
+                {
+                    'table': 'A',
+                    'no': f'{index}/A/NBP',
+                    'effectiveDate': effective_date.isoformat(),
+                    'rates': [
+                        {'currency': currency, 'code': currency, 'mid': get_nbp_rate(currency, effective_date)}
+                        for currency in NBP_CURRENCIES
+                    ],
+                }
+                for index, effective_date in enumerate(get_nbp_dates(tables_match.group('start'), tables_match.group('end')))
+            ] or None
+        if payload is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_nbp_server():
+    """Local stand-in of api.nbp.pl, tax.NBP_API_URL is pointed to it"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NbpHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tax.NBP_API_URL = f'http://127.0.0.1:{server.server_address[1]}/api/exchangerates/'
+    return server
+
+
+def get_timed(timings, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+    return value
+
+
+def run_benchmark(filename, workdir, columnar=False, arithmetic=tax.ARITHMETIC, processes=1, verbosity=tax.VERBOSITY):
+    """Time of every stage of tax.run() pipeline, with empty rates cache"""
+    timings = {}
+    tax.rates_cache = tax.RatesCache(os.path.join(workdir, f'rates{time.perf_counter_ns()}.sqlite3'))
+    NbpHandler.requests_count = 0
+    if columnar:
+        transactions = get_timed(timings, 'parsing', tax.TransactionColumns.from_transactions, tax.iter_transactions([filename], scaled=True))
+        dates = transactions.get_dates()
+        currencies = transactions.currencies
+    else:
+        transactions = get_timed(timings, 'parsing', tax.get_transactions, [filename], scaled=arithmetic in tax.SCALED_ARITHMETICS)
+        dates = tax.get_transactions_dates(transactions)
+        currencies = tax.get_transactions_currencies(transactions)
+    unlisted_currencies = get_timed(timings, 'rate resolution', tax.prefetch_rates, dates, [], currencies)
+    rate_tables = get_timed(timings, 'rate resolution', tax.get_rate_tables, currencies, unlisted_currencies)
+    if columnar:
+        get_timed(timings, 'valuation', transactions.fill_rates, rate_tables)
+        grouped_transactions = get_timed(timings, 'valuation', transactions.get_grouped_transactions, rate_tables)
+    else:
+        get_timed(timings, 'valuation', tax.fill_transactions_with_prices, transactions, rate_tables)
+        get_timed(timings, 'valuation', tax.count_pln_values, transactions)
+        grouped_transactions = get_timed(timings, 'valuation', tax.get_grouped_transactions, transactions)
+    report_operations = {}
+    result = get_timed(
+        timings, 'lot matching', tax.get_processed_transactions_result, grouped_transactions,
+        processes=processes, verbosity=verbosity, arithmetic=arithmetic, report_operations=report_operations,
+    )
+    report_operations['total'] = get_timed(timings, 'report writing', tax.show_results, result, 0)
+    get_timed(timings, 'report writing', tax.print_operations, report_operations, filename=os.path.join(workdir, 'output.csv'))
+    timings['total'] = sum(timings.values())
+    return timings, NbpHandler.requests_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--tickers', type=int, default=100)
+    parser.add_argument('--whole-shares', action='store_true', help='no fractional quantities')
+    parser.add_argument('--no-dividends', action='store_true', help='no DIV and DIVNRA lines')
+    parser.add_argument('--split-tickers', nargs='*', default=tax.default_corporate_actions.get_tickers())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--currencies', nargs='+', default=['USD'], choices=list(NBP_CURRENCIES))
+    parser.add_argument('--statement', help='use this statement instead of generated one')
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('--arithmetic', default=tax.ARITHMETIC, choices=list(tax.GROUP_PROCESSORS))
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--verbosity', type=int, default=tax.VERBOSITY)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print timings as json')
+    args = parser.parse_args()
+
+    server = start_nbp_server()
+    with tempfile.TemporaryDirectory() as workdir:
+        filename = args.statement
+        if filename is None:
+            filename = os.path.join(workdir, 'statement.csv')
+            start = time.perf_counter()
+            write_statement(
+                filename, args.lines, args.tickers, not args.whole_shares, not args.no_dividends, args.split_tickers, args.seed,
+                args.currencies,
+            )
+            print(f'generated {args.lines} lines in {time.perf_counter() - start:.3f}s')
+        runs = []
+        for _ in range(args.repeat):
+            timings, requests_count = run_benchmark(
+                filename, workdir, args.columnar, args.arithmetic, args.processes, args.verbosity,
+            )
+            runs.append({'timings': timings, 'http_requests': requests_count})
+    server.shutdown()
+    if args.json:
+        print(json.dumps(runs, indent=1))
+        return
+    for index, benchmark_run in enumerate(runs):
+        print(f'run {index + 1}, http requests: {benchmark_run["http_requests"]}')
+        for stage, seconds in benchmark_run['timings'].items():
+            print(f'  {stage:<16} {seconds:10.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,133 +1,732 @@
-from collections import OrderedDict
+import abc
+import argparse
+import csv
+from collections import OrderedDict, namedtuple
 from datetime import date, timedelta
 import decimal
+import gzip
+import hashlib
+import heapq
+import io
+import json
 import logging
-import requests
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from fractions import Fraction
+from functools import partial
+from itertools import chain, islice
+from operator import attrgetter
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
 
 DEBUG = False
 
-report_operations = {}
-# {isodate: value}
-# dates here are date of sell (price of currency is the closest date before the sell date)
-prices_of_usd_in_pln_in_date = OrderedDict([
-    ("2020-01-06", 3.8213),
-    ("2020-01-10", 3.8251),
-    ("2020-01-15", 3.8019),
-    ("2020-01-31", 3.8856),
-    ("2020-02-03", 3.8999),
-    ("2020-02-11", 3.8996),
-    ("2020-02-25", 3.9772),
-    ("2020-02-26", 3.9624),
-    ("2020-02-28", 3.9413),
-    ("2020-03-11", 3.8058),
-    ("2020-03-27", 4.1988),
-    ("2020-04-13", 4.1566),
-    ("2020-04-15", 4.1666),
-    ("2020-04-17", 4.1631),
-    ("2020-04-22", 4.1779),
-    ("2020-04-28", 4.1696),
-    ("2020-04-29", 4.184),
-    ("2020-05-01", 4.1729),
-    ("2020-05-11", 4.2065),
-    ("2020-05-18", 4.2135),
-    ("2020-05-20", 4.1645),
-    ("2020-05-21", 4.1619),
-    ("2020-06-01", 4.0031),
-    ("2020-06-22", 3.9741),
-    ("2020-06-23", 3.9667),
-    ("2020-07-01", 3.9806),
-    ("2020-07-06", 3.9764),
-    ("2020-07-09", 3.9666),
-    ("2020-07-28", 3.7643),
-    ("2020-08-11", 3.7393),
-    ("2020-08-26", 3.7144),
-    ("2020-08-27", 3.7269),
-    ("2020-08-28", 3.7286),
-    ("2020-09-01", 3.6924),
-    ("2020-09-04", 3.7337),
-    ("2020-09-10", 3.7871),
-    ("2020-09-14", 3.7534),
-    ("2020-10-12", 3.7913),
-    ("2020-10-14", 3.7932),
-    ("2020-10-15", 3.8301),
-    ("2020-10-19", 3.8976),
-    ("2020-10-29", 3.9313),
-    ("2020-11-05", 3.8996),
-    ("2020-11-09", 3.8194),
-    ("2020-11-18", 3.7877),
-    ("2020-11-19", 3.7621),
-    ("2020-11-20", 3.7872),
-    ("2020-11-25", 3.7625),
-    ("2020-12-01", 3.7364),
-    ("2020-12-02", 3.7367),
-    ("2020-12-04", 3.6981),
-    ("2020-12-14", 3.663),
-    ("2020-12-17", 3.6334),
-    ("2020-12-18", 3.6254),
-])
-
-
-def decimal_prices():
-    print('currency prices:')
-    for k, v in prices_of_usd_in_pln_in_date.items():
-        print(f'{k} : {v}')
-        prices_of_usd_in_pln_in_date[k] = decimal.Decimal(str(v))
-
-
-def get_usd_price_from_nbp_api(requested_date):
-    """
-    {
-        "table": "A",
-        "currency": "dolar amerykański",
-        "code": "USD",
-        "rates": [
-            {
-                "no": "115/A/NBP/2020",
-                "effectiveDate": "2020-06-16",
-                "mid": 3.9058
-            }
-        ]
-    }
+NBP_API_URL = 'http://api.nbp.pl/api/exchangerates/'
+NBP_TABLE = 'A'
+NBP_ALL_CURRENCIES = '*'  # fetched range of whole table, with rates of every currency in it
+DEFAULT_CURRENCY = 'USD'  # currency of other costs
+LOCAL_CURRENCY = 'PLN'  # transactions in it have rate 1, it is not in NBP tables
+NBP_MAX_DAYS_IN_RANGE = 93  # api limit for a single date range query
+NBP_HOLIDAY_MARGIN_DAYS = 10  # fetched before requested date, so holidays can be walked back from cache
+NBP_MAX_HOLIDAY_WALK_BACK_STEPS = 5  # each step looks NBP_HOLIDAY_MARGIN_DAYS further into the past
+NBP_MAX_CONCURRENT_REQUESTS = 4
+NBP_RETRIES = 3
+NBP_RETRY_BACKOFF_SECONDS = 0.5  # doubled after each failed attempt
+NBP_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+NBP_TIMEOUT_SECONDS = 30
+RATES_CACHE_FILENAME = 'nbp_rates.sqlite3'
+RATE_TABLES_DIRECTORY = None  # rate tables built from rates cache are kept here as memory-mapped files
+STATEMENT_FILENAMES = ['2019.csv'] + [f'{i}.2020.csv' for i in range(1, 13)]  # used when no statements are given
+OTHER_COSTS_FILENAME = 'other_costs.csv'
+OUTPUT_FILENAME = 'output.csv'
+LEDGER_FILENAME = None  # one row per lot match, for reconciliation
+LEDGER_FORMAT = 'csv'  # one of LEDGER_WRITERS or LOTS_LEDGER_FORMAT
+LOTS_LEDGER_FORMAT = 'sqlite'  # ledger of lot openings and consumptions, queried by LotsLedger
+REPORT_BUFFER_SIZE = 1024 * 1024
+TAX = decimal.Decimal('0.19')
+WHAT_IF_FILENAME = None  # hypothetical sells evaluated against open lots after run
+WHAT_IF_RANK = 'tax_saved'  # one of SELL_SCENARIO_RANKS
+WHAT_IF_TOP = 20  # best scenarios printed
+RATE_SCALE = 10 ** 6  # rates are kept as integer millionths of pln
+RATE_TABLE_MAGIC = b'NBPRATE1'
+RATE_TABLE_HEADER = struct.Struct('<8sq')  # magic, number of rates
+INSTRUMENTATION_FILENAME = None  # json with timings and counters of run() is saved here
+INSTRUMENTATION_COUNTERS = [
+    'http_requests',
+    'rate_cache_hits',  # per date range needed
+    'rate_cache_misses',
+    'holiday_walk_back_steps',
+    'lines_parsed',
+    'lines_skipped',
+    'lots_matched',
+    'files_parsed',  # statements parsed again in incremental run, not reused
+    'files_reused',
+    'groups_matched',
+    'groups_reused',
+]
+QUANTITY_SCALE = 10 ** 8  # fractional shares are given with 8 digits
+VALUE_SCALE = 10 ** 8
+PLN_SCALE = RATE_SCALE * VALUE_SCALE  # so rate * value is exact
+COLUMNAR_STORE = False  # keep transactions in TransactionColumns, for big inputs
+VECTORIZED_VALUATION = True  # join dates with rate tables in numpy when it is installed
+CHECKPOINT_VERSION = 1
+LOAD_CHECKPOINT = None  # filename of open lots saved at the end of previous period
+SAVE_CHECKPOINT = None  # filename to save open lots at the end of this period
+PIPELINE_CHUNK_TRANSACTIONS = 5000  # parsed transactions after which their rates are requested in pipelined run
+PARALLEL_PARSE_MIN_BYTES = 64 * 1024 * 1024  # smaller plain statements are parsed in one process
+PARALLEL_PARSE_RANGE_BYTES = 8 * 1024 * 1024  # line aligned part of big statement parsed by one worker task
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+PARSE_CACHE_DIRECTORY = None  # parsed statements are kept here, keyed by content hash, and not parsed again
+PARSER_VERSION = 1  # raise when parsing of statements changes, so parse cache files of older version are not used
+TRANSACTION_COLUMNS_MAGIC = b'TXCOLS01'
+TRANSACTION_COLUMNS_HEADER = struct.Struct('<8sqqq')  # magic, parser version, number of rows, length of json with strings
+EXTERNAL_SORT_CHUNK_LINES = 200000  # lines of not sorted statement sorted in memory at once, before spilled to disk
+WATCH_INTERVAL_SECONDS = 2  # statements are checked for changes this often in watch mode
+BATCH_OUTPUT_FILENAME = '{name}.output.csv'  # report of client in batch, when not given in batch file
+STOCK_SPLITS = [
+    # ticker, date, new shares, old shares; quantities of transactions up to the date are adjusted
+    ('TSLA', '2020-08-31', 5, 1),
+]
+CORPORATE_ACTIONS_FILENAME = None  # splits read from this file are used instead of STOCK_SPLITS
+
+
+class Instrumentation(object):
+    """Wall and cpu time of run() stages and counters of work done in them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # counters are incremented from fetching threads too
+        self.reset()
+
+    def reset(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict((counter, 0) for counter in INSTRUMENTATION_COUNTERS)
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['wall_seconds'] += time.perf_counter() - wall_start
+            stage['cpu_seconds'] += time.process_time() - cpu_start
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_counters(self, counters):
+        for counter, value in counters.items():
+            self.count(counter, value)
+
+    def get_report(self):
+        report = {
+            'stages': self.stages,
+            'counters': self.counters,
+        }
+        if resource is not None:
+            # kilobytes on linux, worker processes are counted separately
+            report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report['peak_memory_children_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return report
+
+    def save(self, filename):
+        with open(filename, 'w') as file:
+            json.dump(self.get_report(), file, indent=1)
+
+
+instrumentation = Instrumentation()
+
+
+def get_scaled_integer(value, scale):
+    """Decimal value as integer number of 1 / scale"""
+    scaled_value = value * scale
+    if scaled_value != scaled_value.to_integral_value():
+        raise ValueError(f'{value} is more precise than {scale}')
+    return int(scaled_value)
+
+
+def get_fixed_point_decimal(scaled_value, scale):
+    return decimal.Decimal(scaled_value) / scale
+
+
+def get_uncovered_ranges(covered_ranges, start_date, end_date):
+    """[(start, end), ...] parts of <start_date, end_date> outside of covered ranges sorted by start"""
+    uncovered_ranges = []
+    current = start_date
+    for covered_start, covered_end in covered_ranges:
+        if covered_end < current:
+            continue
+        if covered_start > end_date:
+            break
+        if covered_start > current:
+            uncovered_ranges.append((current, covered_start - timedelta(days=1)))
+        current = max(current, covered_end + timedelta(days=1))
+    if current <= end_date:
+        uncovered_ranges.append((current, end_date))
+    return uncovered_ranges
+
+
+class RatesCache(object):
+    """Persistent store of NBP mid rates keyed by (table, currency, date).
+    Ranges already asked for are remembered as well, so days without published table
+    (weekends, holidays) are not fetched again.
+    Currency codes are kept in lower case.
+    With rate_tables_directory, rate tables of currencies are kept there as files, see get_rate_table.
     """
-    NBP_TABLE_API_URL = 'http://api.nbp.pl/api/exchangerates/rates/A/usd/'
-    url = NBP_TABLE_API_URL + f'{requested_date}/'
-    print(f'getting usd price in pln on {requested_date} : {url}')
-    resp = requests.get(url)
-    return_date = None
+
+    def __init__(self, filename=RATES_CACHE_FILENAME, rate_tables_directory=RATE_TABLES_DIRECTORY):
+        self.filename = filename
+        self.rate_tables_directory = rate_tables_directory
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rates ('
+            'table_name TEXT, currency TEXT, effective_date TEXT, mid TEXT, '
+            'PRIMARY KEY (table_name, currency, effective_date)) WITHOUT ROWID'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fetched_ranges ('
+            'table_name TEXT, currency TEXT, start_date TEXT, end_date TEXT)'
+        )
+        self.connection.commit()
+
+    def get_fetched_ranges(self, table, currency):
+        """Ranges fetched for the currency alone or with whole table"""
+        rows = self.connection.execute(
+            'SELECT start_date, end_date FROM fetched_ranges WHERE table_name = ? AND currency IN (?, ?) ORDER BY start_date',
+            (table, currency, NBP_ALL_CURRENCIES),
+        )
+        return [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in rows]
+
+    def get_missing_ranges(self, table, currency, start_date, end_date):
+        """[(start, end), ...] parts of <start_date, end_date> which were never fetched"""
+        return get_uncovered_ranges(self.get_fetched_ranges(table, currency), start_date, end_date)
+
+    def add_rates(self, table, start_date, end_date, currencies_rates):
+        """currencies_rates: {currency: {isodate: mid}} of every table published between start_date and end_date"""
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?)',
+            [
+                (table, rates_currency, effective_date, str(mid))
+                for rates_currency, rates in currencies_rates.items()
+                for effective_date, mid in rates.items()
+            ],
+        )
+        # today's table may be not published yet
+        last_complete_date = min(end_date, date.today() - timedelta(days=1))
+        if start_date <= last_complete_date:
+            self.connection.execute(
+                'INSERT INTO fetched_ranges VALUES (?, ?, ?, ?)',
+                (table, NBP_ALL_CURRENCIES, start_date.isoformat(), last_complete_date.isoformat()),
+            )
+        self.connection.commit()
+
+    def get_rate(self, table, currency, requested_date):
+        """Mid rate from requested_date or the closest date before it, None if not cached"""
+        if self.get_missing_ranges(table, currency, requested_date, requested_date):
+            return None
+        row = self.connection.execute(
+            'SELECT effective_date, mid FROM rates WHERE table_name = ? AND currency = ? AND effective_date <= ? '
+            'ORDER BY effective_date DESC LIMIT 1',
+            (table, currency, requested_date.isoformat()),
+        ).fetchone()
+        if row is None:
+            return None
+        effective_date, mid = row
+        if self.get_missing_ranges(table, currency, date.fromisoformat(effective_date), requested_date):
+            return None
+        return decimal.Decimal(mid)
+
+    def get_currencies(self, table):
+        """Currencies listed in any cached table"""
+        return {currency for (currency,) in self.connection.execute('SELECT DISTINCT currency FROM rates WHERE table_name = ?', (table,))}
+
+    def get_rates_summary(self, table, currency):
+        """(number of cached rates, first isodate, last isodate)"""
+        return self.connection.execute(
+            'SELECT COUNT(*), MIN(effective_date), MAX(effective_date) FROM rates WHERE table_name = ? AND currency = ?',
+            (table, currency),
+        ).fetchone()
+
+    def get_rates(self, table, currency):
+        """[(isodate, mid), ...] of every cached rate sorted by date"""
+        return self.connection.execute(
+            'SELECT effective_date, mid FROM rates WHERE table_name = ? AND currency = ? ORDER BY effective_date',
+            (table, currency),
+        ).fetchall()
+
+
+class RateTable(object):
+    """Sorted time series of mid rates of single currency.
+    Dates are kept as ordinals and rates as integers scaled by RATE_SCALE, in two parallel arrays,
+    so a rate for any date is found with bisect.
+    Saved file is header followed by both arrays (native byte order), it is memory-mapped when loaded.
+    """
+
+    def __init__(self, ordinals, rates, mapped_file=None):
+        self.ordinals = ordinals
+        self.rates = rates
+        self.mapped_file = mapped_file
+        self.decimal_rates = {}
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def __reduce__(self):
+        """Memory-mapped table is sent to worker processes as arrays"""
+        return self.__class__, (array('q', self.ordinals), array('q', self.rates))
+
+    def get_summary(self):
+        """Same as RatesCache.get_rates_summary"""
+        if not len(self):
+            return 0, None, None
+        return len(self), date.fromordinal(self.ordinals[0]).isoformat(), date.fromordinal(self.ordinals[-1]).isoformat()
+
+    @classmethod
+    def from_rates(cls, rates):
+        """rates: [(isodate, mid), ...] sorted by date"""
+        ordinals = array('q')
+        scaled_rates = array('q')
+        for effective_date, mid in rates:
+            ordinals.append(date.fromisoformat(effective_date).toordinal())
+            scaled_rates.append(get_scaled_integer(decimal.Decimal(mid), RATE_SCALE))
+        return cls(ordinals, scaled_rates)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as file:
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = RATE_TABLE_HEADER.unpack_from(mapped_file)
+        if magic != RATE_TABLE_MAGIC:
+            mapped_file.close()
+            raise ValueError(f'{filename} is not a rate table')
+        view = memoryview(mapped_file)
+        ordinals_end = RATE_TABLE_HEADER.size + count * 8
+        ordinals = view[RATE_TABLE_HEADER.size:ordinals_end].cast('q')
+        rates = view[ordinals_end:ordinals_end + count * 8].cast('q')
+        return cls(ordinals, rates, mapped_file)
+
+    def save(self, filename):
+        """Saved to temporary file first, so reader never sees half of it"""
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as file:
+            file.write(RATE_TABLE_HEADER.pack(RATE_TABLE_MAGIC, len(self.ordinals)))
+            file.write(array('q', self.ordinals).tobytes())
+            file.write(array('q', self.rates).tobytes())
+        os.replace(file.name, filename)
+
+    def get_rate_by_index(self, index):
+        if index < 0:
+            return None
+        rate = self.decimal_rates.get(index)
+        if rate is None:
+            rate = decimal.Decimal(self.rates[index]) / RATE_SCALE
+            self.decimal_rates[index] = rate
+        return rate
+
+    def get_rate_before(self, requested_date):
+        """Rate from the last business day strictly before requested date"""
+        return self.get_rate_by_index(bisect_left(self.ordinals, requested_date.toordinal()) - 1)
+
+    def get_scaled_rate_before(self, ordinal):
+        """Same as get_rate_before, but for date ordinal and rate scaled by RATE_SCALE, 0 when there is no rate"""
+        index = bisect_left(self.ordinals, ordinal) - 1
+        return self.rates[index] if index >= 0 else 0
+
+    def get_calendar_indexes(self, numpy, first_ordinal, last_ordinal):
+        """Numpy array of get_indexes_before for every day from first_ordinal to last_ordinal.
+        Days are far fewer than transactions, so transactions are joined by plain indexing into it.
+        """
+        table_ordinals = numpy.frombuffer(self.ordinals, dtype=numpy.int64)
+        calendar = numpy.arange(first_ordinal, last_ordinal + 1, dtype=numpy.int64)
+        return numpy.searchsorted(table_ordinals, calendar, side='left') - 1
+
+    def get_indexes_before(self, ordinals):
+        """[index of rate from the last business day before ordinal, ...], -1 when there is no rate.
+        All ordinals are joined with table at once, in numpy when it is available.
+        """
+        numpy = get_numpy()
+        if numpy is not None and ordinals:
+            ordinals = numpy.asarray(ordinals, dtype=numpy.int64)
+            first_ordinal = int(ordinals.min())
+            calendar_indexes = self.get_calendar_indexes(numpy, first_ordinal, int(ordinals.max()))
+            return calendar_indexes[ordinals - first_ordinal].tolist()
+        indexes_of_ordinals = {}
+        for ordinal in ordinals:
+            if ordinal not in indexes_of_ordinals:
+                indexes_of_ordinals[ordinal] = bisect_left(self.ordinals, ordinal) - 1
+        return [indexes_of_ordinals[ordinal] for ordinal in ordinals]
+
+    def get_scaled_rates_before(self, ordinals):
+        """Same as get_scaled_rate_before for numpy array of ordinals"""
+        numpy = get_numpy()
+        if not len(self) or not len(ordinals):
+            return numpy.zeros(len(ordinals), dtype=numpy.int64)
+        first_ordinal = int(ordinals.min())
+        calendar_indexes = self.get_calendar_indexes(numpy, first_ordinal, int(ordinals.max()))
+        calendar_rates = numpy.where(calendar_indexes >= 0, numpy.frombuffer(self.rates, dtype=numpy.int64)[calendar_indexes], 0)
+        return calendar_rates[ordinals - first_ordinal]
+
+
+numpy_module = None
+
+
+def get_numpy():
+    """numpy imported when first needed, it is slow to import. None when not installed or VECTORIZED_VALUATION is off"""
+    global numpy_module
+    if not VECTORIZED_VALUATION:
+        return None
+    if numpy_module is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        numpy_module = numpy
+    return numpy_module or None
+
+
+rates_cache = None
+nbp_session = None
+
+
+def get_rates_cache():
+    global rates_cache
+    if rates_cache is None:
+        rates_cache = RatesCache()
+    return rates_cache
+
+
+def open_rates_cache(filename, rate_tables_directory=RATE_TABLES_DIRECTORY):
+    """Use rates cache from given file instead of default one"""
+    global rates_cache
+    if rates_cache is None or (rates_cache.filename, rates_cache.rate_tables_directory) != (filename, rate_tables_directory):
+        rates_cache = RatesCache(filename, rate_tables_directory)
+    return rates_cache
+
+
+def get_nbp_session():
+    """Keep-alive session shared by all api requests, big enough for concurrent fetching"""
+    global nbp_session
+    if nbp_session is None:
+        import requests  # only when something has to be fetched, it is slow to import
+        nbp_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=NBP_MAX_CONCURRENT_REQUESTS,
+        )
+        nbp_session.mount('http://', adapter)
+        nbp_session.mount('https://', adapter)
+        nbp_session.headers['Accept'] = 'application/json'
+    return nbp_session
+
+
+def get_tables_from_nbp_api(start_date, end_date):
+    """
+    [
+        {
+            "table": "A",
+            "no": "115/A/NBP/2020",
+            "effectiveDate": "2020-06-16",
+            "rates": [
+                {
+                    "currency": "dolar amerykański",
+                    "code": "USD",
+                    "mid": 3.9058
+                },
+                ...
+            ]
+        },
+        ...
+    ]
+    returned as {currency: {isodate: mid}}
+    """
+    url = NBP_API_URL + f'tables/{NBP_TABLE}/{start_date.isoformat()}/{end_date.isoformat()}/'
+    print(f'getting prices in pln from {start_date} to {end_date} : {url}')
+    session = get_nbp_session()
+    import requests  # already imported by get_nbp_session
+    resp = None
+    for attempt in range(NBP_RETRIES + 1):
+        if attempt:
+            time.sleep(NBP_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        try:
+            instrumentation.count('http_requests')
+            resp = session.get(url, timeout=NBP_TIMEOUT_SECONDS)
+        except requests.RequestException as error:
+            logging.error(f'getting {url} failed: {error}')
+            resp = None
+            continue
+        if resp.status_code not in NBP_RETRY_STATUS_CODES:
+            break
+        logging.error(f'getting {url} failed: {resp.status_code}')
+    if resp is None:
+        return None
+    if resp.status_code == 404:
+        # no table published in whole range
+        return {}
     if resp.status_code != 200:
         logging.error(f'getting {url} failed')
-        next_date = date.fromisoformat(requested_date) - timedelta(days=1)
-        return_date = get_usd_price_from_nbp_api(next_date.isoformat())
+        return None
+    currencies_rates = {}
+    for table in resp.json(parse_float=decimal.Decimal):
+        for rate in table['rates']:
+            currencies_rates.setdefault(rate['code'].lower(), OrderedDict())[table['effectiveDate']] = rate['mid']
+    return currencies_rates
+
+
+def get_date_ranges_to_fetch(requested_dates):
+    """Merge requested dates (with holiday margin) into ranges, not longer than api limit"""
+    ranges = []
+    for requested_date in sorted(set(requested_dates)):
+        start_date = requested_date - timedelta(days=NBP_HOLIDAY_MARGIN_DAYS)
+        if ranges and start_date <= ranges[-1][1] + timedelta(days=1):
+            ranges[-1] = (ranges[-1][0], requested_date)
+        else:
+            ranges.append((start_date, requested_date))
+    chunks = []
+    for start_date, end_date in ranges:
+        while start_date <= end_date:
+            chunk_end_date = min(end_date, start_date + timedelta(days=NBP_MAX_DAYS_IN_RANGE - 1))
+            chunks.append((start_date, chunk_end_date))
+            start_date = chunk_end_date + timedelta(days=1)
+    return chunks
+
+
+def fill_rates_cache(requested_dates, currencies=(DEFAULT_CURRENCY,)):
+    """Fetch concurrently every not cached range needed to get rates for requested dates,
+    whole table is fetched, so one request serves all currencies.
+    Raises ConnectionError when any range is not fetched after all retries, fetched ones are cached anyway.
+    """
+    cache = get_rates_cache()
+    missing_ranges = []
+    for start_date, end_date in get_date_ranges_to_fetch(requested_dates):
+        range_missing_ranges = []
+        for currency in currencies:
+            range_missing_ranges.extend(cache.get_missing_ranges(NBP_TABLE, currency.lower(), start_date, end_date))
+        instrumentation.count('rate_cache_misses' if range_missing_ranges else 'rate_cache_hits')
+        for missing_range in range_missing_ranges:
+            if missing_range not in missing_ranges:
+                missing_ranges.append(missing_range)
+    if not missing_ranges:
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    get_nbp_session()  # created once, before fetching threads share it
+    with ThreadPoolExecutor(max_workers=NBP_MAX_CONCURRENT_REQUESTS) as executor:
+        fetched_tables = executor.map(lambda missing_range: get_tables_from_nbp_api(*missing_range), missing_ranges)
+        # sqlite connection is used only from this thread
+        failed_ranges = []
+        for (missing_start, missing_end), currencies_rates in zip(missing_ranges, fetched_tables):
+            if currencies_rates is None:
+                failed_ranges.append((missing_start, missing_end))
+            else:
+                cache.add_rates(NBP_TABLE, missing_start, missing_end, currencies_rates)
+    if failed_ranges:
+        raise ConnectionError(f'NBP table {NBP_TABLE} is not fetched for {get_ranges_description(failed_ranges)}')
+
+
+def get_ranges_description(ranges):
+    return ', '.join(f'{start_date} - {end_date}' for start_date, end_date in ranges)
+
+
+def get_price_from_nbp_api(requested_date, currency=DEFAULT_CURRENCY):
+    """Price from requested date, or from the closest date before it when no table was published"""
+    requested_date = date.fromisoformat(requested_date)
+    cache = get_rates_cache()
+    price = cache.get_rate(NBP_TABLE, currency.lower(), requested_date)
+    range_end_date = requested_date
+    for _ in range(NBP_MAX_HOLIDAY_WALK_BACK_STEPS):
+        if price is not None:
+            break
+        instrumentation.count('holiday_walk_back_steps')
+        fill_rates_cache([range_end_date], [currency])
+        price = cache.get_rate(NBP_TABLE, currency.lower(), requested_date)
+        range_end_date -= timedelta(days=NBP_HOLIDAY_MARGIN_DAYS + 1)
+    if price is None:
+        logging.error(f'no {currency} price in pln on {requested_date.isoformat()}')
+    return price
+
+
+def get_unlisted_currencies(currencies):
+    """Currencies confirmed missing from fetched NBP tables, none when no table is fetched yet.
+    DEFAULT_CURRENCY and LOCAL_CURRENCY never are.
+    """
+    listed_currencies = get_rates_cache().get_currencies(NBP_TABLE)
+    if not listed_currencies:
+        return []
+    return [
+        currency for currency in currencies
+        if currency not in (DEFAULT_CURRENCY, LOCAL_CURRENCY) and currency.lower() not in listed_currencies
+    ]
+
+
+def prefetch_rates(transactions_dates, other_costs_dates, currencies=(DEFAULT_CURRENCY,)):
+    """Resolve all needed rates at once, so later lookups are done only in local rate tables.
+    Returns currencies which are not in NBP table, their transactions are skipped.
+    """
+    requested_dates = set()
+    for t_date in chain(transactions_dates, other_costs_dates):
+        requested_dates.add(t_date - timedelta(days=1))  # according to law, price should be day before transaction date
+    currencies = [currency for currency in currencies if currency != LOCAL_CURRENCY]
+    # one request per range of dates instead of one per date and currency
+    fill_rates_cache(requested_dates, currencies)
+    cache = get_rates_cache()
+    unlisted_currencies = get_unlisted_currencies(currencies)
+    for currency in currencies:
+        if currency in unlisted_currencies:
+            # no holiday to walk back
+            logging.error(f'{currency} is not in NBP table {NBP_TABLE}, transactions in {currency} are skipped')
+            continue
+        for requested_date in sorted(requested_dates):
+            if cache.get_rate(NBP_TABLE, currency.lower(), requested_date) is None:
+                get_price_from_nbp_api(requested_date.isoformat(), currency)
+    return unlisted_currencies
+
+
+def get_rate_table(currency=DEFAULT_CURRENCY):
+    """Rate table of every rate in cache.
+    With rate_tables_directory of the cache, it is memory-mapped from file there,
+    which is built again whenever the cache holds other rates than the file.
+    """
+    cache = get_rates_cache()
+    if cache.rate_tables_directory:
+        rate_table = get_mapped_rate_table(cache, currency)
     else:
-        value = resp.json()['rates'][0]['mid']
-        print(f'{requested_date} : {value}')
-        return_date = value
-    return return_date
+        rate_table = RateTable.from_rates(cache.get_rates(NBP_TABLE, currency.lower()))
+    print(f'{currency} prices in pln: {len(rate_table)}')
+    return rate_table
+
+
+def get_mapped_rate_table(cache, currency):
+    filename = os.path.join(cache.rate_tables_directory, f'{NBP_TABLE.lower()}_{currency.lower()}.rates')
+    try:
+        rate_table = RateTable.load(filename)
+    except (FileNotFoundError, ValueError):
+        rate_table = None
+    if rate_table is None or rate_table.get_summary() != tuple(cache.get_rates_summary(NBP_TABLE, currency.lower())):
+        os.makedirs(cache.rate_tables_directory, exist_ok=True)
+        RateTable.from_rates(cache.get_rates(NBP_TABLE, currency.lower())).save(filename)
+        rate_table = RateTable.load(filename)
+    return rate_table
+
+
+def get_local_currency_rate_table():
+    """Rate 1 for every date"""
+    return RateTable.from_rates([(date.min.isoformat(), '1')])
+
+
+def get_rate_tables(currencies, unlisted_currencies=()):
+    """{currency: rate table} of every currency of transactions and DEFAULT_CURRENCY, except those not in NBP table"""
+    rate_tables = OrderedDict()
+    for currency in sorted(set(currencies) | {DEFAULT_CURRENCY}):
+        if currency not in unlisted_currencies:
+            rate_tables[currency] = get_local_currency_rate_table() if currency == LOCAL_CURRENCY else get_rate_table(currency)
+    return rate_tables
+
+
+def get_split_adjusted_quantity(quantity, multiplier):
+    """Quantity times split multiplier, rounded like fractional shares when multiplier is not integer"""
+    if multiplier == 1:
+        return quantity
+    quantity = quantity * multiplier.numerator
+    if multiplier.denominator != 1:
+        quantity = (quantity / multiplier.denominator).quantize(decimal.Decimal(1) / QUANTITY_SCALE)
+    return quantity
+
+
+class CorporateActions(object):
+    """Registry of stock splits and reverse splits of every ticker.
+    Split dates of ticker are kept as sorted ordinals together with cumulative multipliers
+    of all its splits from given date on, so multiplier for any transaction date is found with bisect.
+    """
+
+    def __init__(self, splits=()):
+        """splits: [(ticker, date, new shares, old shares), ...] in any order"""
+        splits_of_tickers = {}
+        for ticker, split_date, new_shares, old_shares in splits:
+            if not isinstance(split_date, date):
+                split_date = date.fromisoformat(split_date)
+            splits_of_tickers.setdefault(ticker, []).append((split_date.toordinal(), Fraction(new_shares, old_shares)))
+        self.ordinals = {}
+        self.multipliers = {}
+        for ticker, ticker_splits in splits_of_tickers.items():
+            ticker_splits.sort()
+            multipliers = [Fraction(1)]  # after the last split
+            for _, ratio in reversed(ticker_splits):
+                multipliers.append(multipliers[-1] * ratio)
+            multipliers.reverse()
+            self.ordinals[ticker] = array('i', [ordinal for ordinal, _ in ticker_splits])
+            self.multipliers[ticker] = multipliers
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Example line: TSLA 2020-08-31 5:1
+        reverse split is given as 1:10, empty lines and lines starting with # are skipped
+        """
+        splits = []
+        for line_number, line in iter_statement_lines(filename):
+            if line.startswith('#'):
+                continue
+            try:
+                ticker, split_date, ratio = line.split()
+                new_shares, old_shares = ratio.split(':')
+                splits.append((ticker, date.fromisoformat(split_date), int(new_shares), int(old_shares)))
+            except ValueError as error:
+                raise ValueError(f'{filename}:{line_number}: wrong corporate action {line}: {error}')
+        return cls(splits)
 
+    def get_tickers(self):
+        return list(self.ordinals)
 
-# https://api.nbp.pl/#kursyWalut
-def fill_prices_of_usd_in_pln_in_date(dates):
-    for t_date in dates:
-        if t_date not in prices_of_usd_in_pln_in_date:
-            date_day_before = date.fromisoformat(t_date) - timedelta(days=1)  # according to law, price should be day before transaction date
-            date_day_before = date_day_before.isoformat()
-            price = get_usd_price_from_nbp_api(date_day_before)
-            if price:
-                prices_of_usd_in_pln_in_date[t_date] = price
-    print(prices_of_usd_in_pln_in_date)
+    def get_multiplier(self, ticker, transaction_date):
+        """Product of ratios of splits of the ticker made on transaction date or later"""
+        ordinals = self.ordinals.get(ticker)
+        if ordinals is None:
+            return 1
+        return self.multipliers[ticker][bisect_left(ordinals, transaction_date.toordinal())]
+
+
+default_corporate_actions = CorporateActions(STOCK_SPLITS)
 
 
 class Transaction(object):
+    """value_usd, single_stock_price and usd_price_in_given_date are in currency_code of the transaction.
+    scaled_quantity, scaled_value and scaled_rate are the same values as integers scaled by QUANTITY_SCALE,
+    VALUE_SCALE and RATE_SCALE, kept when they are known anyway, for fixed point arithmetic. None when not known.
+    """
+    __slots__ = (
+        'currency_code',
+        'entity_code',
+        'entity_name',
+        'transaction_type',
+        'date',
+        'value_usd',
+        'quantity_of_stocks',
+        'single_stock_price',
+        'value_pln',
+        'usd_price_in_given_date',
+        'scaled_quantity',
+        'scaled_value',
+        'scaled_rate',
+    )
     TRANSACTION_TYPES = [
         'BUY',
         'SELL',
         'DIV',
         'DIVNRA',
     ]
-    STOCK_SPLIT_DATES = {
-        'TSLA': {'date': '2020-08-31', 'multiplier': 5}
-    }
-
     @staticmethod
     def get_formated_input_value(value):
         value = value.replace(',', '')
@@ -135,29 +734,43 @@ class Transaction(object):
         value = value.replace(')', '')
         return value
 
-    def __init__(self, entity_code, entity_name, transaction_type, transaction_date, value, quantity_of_stocks):
+    def __init__(self, entity_code, entity_name, transaction_type, transaction_date, value, quantity_of_stocks, currency_code=DEFAULT_CURRENCY, split_multiplier=1):
+        self.currency_code = currency_code
         self.entity_code = entity_code
         self.entity_name = entity_name
         self.transaction_type = transaction_type
         if transaction_type not in self.TRANSACTION_TYPES:
             error = 'Wrong transaction type {}'.format(transaction_type)
             raise TypeError(error)
-        self.date = date.fromisoformat(transaction_date)
-        multiplier = 1
-        if self.entity_code in self.STOCK_SPLIT_DATES:
-            split_info = self.STOCK_SPLIT_DATES.get(self.entity_code)
-            if self.date <= date.fromisoformat(split_info.get('date')):
-                multiplier = split_info.get('multiplier')
+        self.date = transaction_date if isinstance(transaction_date, date) else date.fromisoformat(transaction_date)
         try:
             value = self.get_formated_input_value(value)
             quantity_of_stocks = self.get_formated_input_value(quantity_of_stocks)
             self.value_usd = decimal.Decimal(value)
-            self.quantity_of_stocks = decimal.Decimal(quantity_of_stocks) * decimal.Decimal(multiplier)
+            self.quantity_of_stocks = get_split_adjusted_quantity(decimal.Decimal(quantity_of_stocks), split_multiplier)
         except (ValueError, decimal.InvalidOperation()) as error:
             raise error
         self.single_stock_price = abs(self.value_usd / self.quantity_of_stocks) if self.quantity_of_stocks != 0 else 0
         self.value_pln = 0
         self.usd_price_in_given_date = 0
+        self.scaled_quantity = self.scaled_value = self.scaled_rate = None
+
+    @classmethod
+    def from_values(cls, entity_code, entity_name, transaction_type, transaction_date, value_usd, quantity_of_stocks, usd_price_in_given_date=0, currency_code=DEFAULT_CURRENCY):
+        """Transaction from already parsed and split adjusted values"""
+        transaction = cls.__new__(cls)
+        transaction.currency_code = currency_code
+        transaction.entity_code = entity_code
+        transaction.entity_name = entity_name
+        transaction.transaction_type = transaction_type
+        transaction.date = transaction_date
+        transaction.value_usd = value_usd
+        transaction.quantity_of_stocks = quantity_of_stocks
+        transaction.single_stock_price = abs(value_usd / quantity_of_stocks) if quantity_of_stocks != 0 else 0
+        transaction.value_pln = 0
+        transaction.usd_price_in_given_date = usd_price_in_given_date
+        transaction.scaled_quantity = transaction.scaled_value = transaction.scaled_rate = None
+        return transaction
 
     def get_value_pln_for_given_amount_of_stocks(self, amount_of_stocks):
         percent = amount_of_stocks / self.quantity_of_stocks
@@ -170,44 +783,160 @@ class Transaction(object):
             self.value_pln = self.usd_price_in_given_date * self.value_usd
 
     def __str__(self):
-        return f'<[{self.transaction_type}][{self.entity_code}][Q: {self.quantity_of_stocks}][{self.date.isoformat()}] PLN {self.value_pln} = {self.usd_price_in_given_date} * USD {self.value_usd}>'
+        return f'<[{self.transaction_type}][{self.entity_code}][Q: {self.quantity_of_stocks}][{self.date.isoformat()}] PLN {self.value_pln} = {self.usd_price_in_given_date} * {self.currency_code} {self.value_usd}>'
 
     def __repr__(self):
         price_per_stock = round(self.value_usd / self.quantity_of_stocks, 4) if self.quantity_of_stocks != 0 else 'NoPrice'
-        return f'<[{self.transaction_type}][{self.entity_code}][Q: {self.quantity_of_stocks}][{self.date.isoformat()}] PLN {self.value_pln} = {self.usd_price_in_given_date} * USD {self.value_usd} (stock_price: {price_per_stock})>'
+        return f'<[{self.transaction_type}][{self.entity_code}][Q: {self.quantity_of_stocks}][{self.date.isoformat()}] PLN {self.value_pln} = {self.usd_price_in_given_date} * {self.currency_code} {self.value_usd} (stock_price: {price_per_stock})>'
 
 
-def get_data_from_file(filename):
-    with open(filename) as file:
-        data = file.readlines()
-        data_cleaned = []
-        for dat in data:
-            if dat:
-                dat = dat.replace('\n', '')
-                data_cleaned.append(dat)
-        return data_cleaned
-
-
-def get_parsed_company_data(company_data):
-    """Transform lane into code and name.
-    Ex. AMD - NAME -
-    """
-    company_splited = company_data.split('-')
-    return {
-        'code': company_splited[0],
-        'name': company_splited[1],
-    }
+# 01/31/2020 02/04/2020 USD BUY UBER - UBER TECHNOLOGIES INC COM - TRD UBER B 9 at 36.01 Agency. 9 36.01 324.0
+STATEMENT_LINE_RE = re.compile(
+    r'(?P<month>\d\d)/(?P<day>\d\d)/(?P<year>\d{4}) \S* (?P<currency_code>\S*) (?P<transaction_type>\S*) '
+    r'(?P<company_code>[^-]*)-(?P<company_name>[^-]*)(?:-.*)? '
+    r'(?P<quantity_of_stocks>\S*) (?P<price_of_stock>\S*) (?P<amount>\S*)$'
+)
 
 
-def get_converted_date(unconverted_date):
-    """01/15/2020 -> 2020-01-15"""
-    unconverted_date = unconverted_date.split('/')
-    dd = unconverted_date[1]
-    mm = unconverted_date[0]
-    yy = unconverted_date[2]
+zstandard_module = None
 
-    converted_date = f'{yy}-{mm}-{dd}'
-    return converted_date
+
+def get_zstandard():
+    """zstandard imported when first needed, None when not installed"""
+    global zstandard_module
+    if zstandard_module is None:
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = False
+        zstandard_module = zstandard
+    return zstandard_module or None
+
+
+def get_statement_compression(filename):
+    """'gzip', 'zstd' or None for plain statement, told by magic bytes, not by extension"""
+    with open(filename, 'rb') as file:
+        magic = file.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+@contextmanager
+def open_statement_lines(filename):
+    """Iterator of binary lines of statement. Plain statement is read through mmap,
+    compressed one is decompressed in a stream, so it is never whole in memory.
+    """
+    compression = get_statement_compression(filename)
+    if compression == 'gzip':
+        with gzip.open(filename, 'rb') as file:
+            yield file
+    elif compression == 'zstd':
+        zstandard = get_zstandard()
+        if zstandard is None:
+            raise ValueError(f'{filename}: zstandard is not installed, zstd compressed statement can not be read')
+        with open(filename, 'rb') as file, zstandard.ZstdDecompressor().stream_reader(file) as reader:
+            yield io.BufferedReader(reader)
+    else:
+        with open(filename, 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                yield iter(())  # empty file can not be mapped
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield iter(mapped.readline, b'')
+
+
+def iter_numbered_lines(lines):
+    """Yields (line number, line) of not empty binary lines"""
+    for line_number, line in enumerate(lines, 1):
+        line = line.decode().rstrip('\r\n')
+        if line:
+            yield line_number, line
+
+
+def iter_statement_lines(filename):
+    """Yields (line number, line) of not empty lines, file is read lazily"""
+    with open_statement_lines(filename) as lines:
+        yield from iter_numbered_lines(lines)
+
+
+def get_statement_byte_ranges(filename, range_bytes=PARALLEL_PARSE_RANGE_BYTES):
+    """[(start, end), ...] line aligned byte ranges of plain statement, each about range_bytes long"""
+    ranges = []
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return ranges
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0
+            while start < size:
+                end = mapped.find(b'\n', min(start + range_bytes, size) - 1)
+                end = size if end == -1 else end + 1
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+STATEMENT_DATE_RE = re.compile(r'(?P<month>\d\d)/(?P<day>\d\d)/(?P<year>\d{4}) ')
+
+
+def get_statement_line_sort_key(line):
+    """Trade date of statement line as YYYYMMDD, empty for lines without date"""
+    match = STATEMENT_DATE_RE.match(line)
+    if match is None:
+        return ''
+    return match.group('year') + match.group('month') + match.group('day')
+
+
+def is_statement_sorted(filename):
+    """True when trade dates of statement never go back, lines without date are not taken into account"""
+    previous_key = ''
+    for _, line in iter_statement_lines(filename):
+        key = get_statement_line_sort_key(line)
+        if key and key < previous_key:
+            return False
+        previous_key = key or previous_key
+    return True
+
+
+def iter_sorted_run(file):
+    for run_line in file:
+        key, line_number, line = run_line.rstrip('\n').split('\t', 2)
+        yield key, int(line_number), line
+
+
+def iter_externally_sorted_statement_lines(filename, chunk_lines=EXTERNAL_SORT_CHUNK_LINES):
+    """Same as iter_statement_lines, but sorted by trade date, lines of the same date stay in order of the file.
+    Chunks of chunk_lines are sorted in memory and spilled to temporary files, which are merged.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        run_filenames = []
+        chunk = []
+        for line_number, line in chain(iter_statement_lines(filename), [(None, None)]):
+            if line is not None:
+                chunk.append((get_statement_line_sort_key(line), line_number, line))
+            if len(chunk) >= chunk_lines or (line is None and run_filenames and chunk):
+                chunk.sort()
+                run_filename = os.path.join(directory, f'{len(run_filenames)}.run')
+                with open(run_filename, 'w') as run_file:
+                    run_file.writelines(f'{key}\t{chunk_line_number}\t{chunk_line}\n' for key, chunk_line_number, chunk_line in chunk)
+                run_filenames.append(run_filename)
+                chunk = []
+        if not run_filenames:
+            # small statement, sorted only in memory
+            chunk.sort()
+            for _, line_number, line in chunk:
+                yield line_number, line
+            return
+        run_files = [open(run_filename) for run_filename in run_filenames]
+        try:
+            for _, line_number, line in heapq.merge(*[iter_sorted_run(run_file) for run_file in run_files]):
+                yield line_number, line
+        finally:
+            for run_file in run_files:
+                run_file.close()
 
 
 def get_parsed_data_line(data_lane):
@@ -215,48 +944,209 @@ def get_parsed_data_line(data_lane):
     Example input: 01/31/2020 02/04/2020 USD BUY UBER - UBER TECHNOLOGIES INC COM - TRD UBER B 9 at 36.01 Agency. 9 36.01 324.0
     example output: {'trade_date': '2020-01-15', 'currency_code': 'USD', 'transaction_type': 'BUY', 'company_code': 'TSLA ', 'company_name': ' TESLA INC COM ', 'quantity_of_stocks': '0.37564776', 'price_of_stock': '532.60', 'amount': '200.07'}
     """
-    prased_data = {}
-    data_splited = data_lane.split(' ',  maxsplit=4)
-    data_rsplited = data_lane.rsplit(' ', maxsplit=3)
-    prased_data['trade_date'] = get_converted_date(data_splited[0])
-    prased_data['currency_code'] = data_splited[2]
-    prased_data['transaction_type'] = data_splited[3]
-
-    company_data_parsed = get_parsed_company_data(data_splited[4])
-    prased_data['company_code'] = company_data_parsed.get('code')
-    prased_data['company_name'] = company_data_parsed.get('name')
-    prased_data['quantity_of_stocks'] = data_rsplited[1]
-    prased_data['price_of_stock'] = data_rsplited[2]
-    prased_data['amount'] = data_rsplited[3]
+    match = STATEMENT_LINE_RE.match(data_lane)
+    if match is None:
+        raise ValueError(f'Wrong statement line {data_lane}')
+    prased_data = match.groupdict()
+    prased_data['trade_date'] = '{}-{}-{}'.format(prased_data.pop('year'), prased_data.pop('month'), prased_data.pop('day'))
     return prased_data
 
 
-def get_transactions(filenames):
-    transactions = []
-    for filename in filenames:
-        data = get_data_from_file(filename)
-        for dat in data:
-            parsed_data = get_parsed_data_line(dat)
-            name = '{}: {}'.format(
-                parsed_data.get('company_code').strip(),
-                parsed_data.get('company_name').strip(),
-            )
+def get_transaction_from_match(match, corporate_actions=default_corporate_actions):
+    company_code = match.group('company_code').strip()
+    transaction_date = date(int(match.group('year')), int(match.group('month')), int(match.group('day')))
+    return Transaction(
+        company_code,
+        '{}: {}'.format(company_code, match.group('company_name').strip()),
+        match.group('transaction_type'),
+        transaction_date,
+        match.group('amount'),
+        match.group('quantity_of_stocks'),
+        match.group('currency_code'),
+        corporate_actions.get_multiplier(company_code, transaction_date),
+    )
+
+
+def iter_statement_transactions(filename, lines, corporate_actions, errors=None, scaled=False):
+    """Yields transactions from (line number, line) of statement, wrong lines are logged with their number and skipped.
+    When errors list is given, (line number, error, line) of wrong lines are put into it instead of logging.
+    With scaled, quantity and value are kept as scaled integers too, for columnar store, parse cache and fixed point
+    arithmetic, lines more precise than QUANTITY_SCALE or VALUE_SCALE are wrong then.
+    """
+    for line_number, line in lines:
+        match = STATEMENT_LINE_RE.match(line)
+        error = None
+        if match is None:
+            error = 'wrong line format'
+        else:
             try:
-                transaction = Transaction(
-                    parsed_data.get('company_code').strip(),
-                    name,
-                    parsed_data.get('transaction_type').strip(),
-                    parsed_data.get('trade_date'),
-                    parsed_data.get('amount'),
-                    parsed_data.get('quantity_of_stocks'),
-                )
-                transactions.append(transaction)
-            except (TypeError, ValueError, decimal.InvalidOperation):
-                error = f'skipped {dat}'
-                logging.error(error)
+                transaction = get_transaction_from_match(match, corporate_actions)
+                if scaled:
+                    transaction.scaled_quantity = get_scaled_integer(transaction.quantity_of_stocks, QUANTITY_SCALE)
+                    transaction.scaled_value = get_scaled_integer(transaction.value_usd, VALUE_SCALE)
+            except (TypeError, ValueError, decimal.InvalidOperation) as transaction_error:
+                error = transaction_error
+        if error is not None:
+            instrumentation.count('lines_skipped')
+            if errors is None:
+                logging.error(f'{filename}:{line_number}: {error}, skipped {line}')
+            else:
+                errors.append((line_number, str(error), line))
+            continue
+        instrumentation.count('lines_parsed')
+        yield transaction
+
+
+def iter_mapped_range_lines(mapped, start, end):
+    mapped.seek(start)
+    while mapped.tell() < end:
+        yield mapped.readline()
+
+
+def get_parsed_statement_range(filename, start, end, corporate_actions):
+    """(number of lines, TransactionColumns, wrong lines) of byte range of plain statement,
+    line numbers are counted from the range start.
+    Columns are sent back from worker process many times faster than transaction objects.
+    """
+    errors = []
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        transactions = TransactionColumns.from_transactions(iter_statement_transactions(
+            filename, iter_numbered_lines(iter_mapped_range_lines(mapped, start, end)), corporate_actions, errors, scaled=True,
+        ))
+        lines_count = mapped[start:end].count(b'\n') + (not mapped[start:end].endswith(b'\n'))
+    return lines_count, transactions, errors
+
+
+def get_parallel_parsed_statement(filename, corporate_actions, processes):
+    """TransactionColumns of big plain statement in order of lines, its byte ranges are parsed by pool of worker processes"""
+    from concurrent.futures import ProcessPoolExecutor
+    starts, ends = zip(*get_statement_byte_ranges(filename))
+    transactions = TransactionColumns()
+    first_line_number = 1
+    with ProcessPoolExecutor(max_workers=processes or None) as executor:
+        parsed_ranges = executor.map(partial(get_parsed_statement_range, filename, corporate_actions=corporate_actions), starts, ends)
+        for lines_count, range_transactions, errors in parsed_ranges:
+            for line_number, error, line in errors:
+                logging.error(f'{filename}:{first_line_number + line_number - 1}: {error}, skipped {line}')
+            # counted in workers, lost with them
+            instrumentation.count('lines_parsed', len(range_transactions))
+            instrumentation.count('lines_skipped', len(errors))
+            transactions.extend(range_transactions)
+            first_line_number += lines_count
     return transactions
 
 
+def iter_transactions(filenames, corporate_actions=None, scaled=False):
+    """Yields transactions from statements line by line, in order of files and lines.
+    Quantities are adjusted by splits from corporate_actions, default_corporate_actions when not given.
+    """
+    corporate_actions = corporate_actions or default_corporate_actions
+    for filename in filenames:
+        yield from iter_statement_transactions(filename, iter_statement_lines(filename), corporate_actions, scaled=scaled)
+
+
+def get_statement_transactions(filename, corporate_actions, parse_processes=1, scaled=False):
+    """Transactions of single statement in chronological order, transactions of the same date stay in order of lines.
+    Sorted statement is read lazily, not sorted one is sorted externally first.
+    With parse_processes other than 1, big plain statement of scaled transactions is parsed by worker processes,
+    whole in memory, as workers send them back in columnar store.
+    """
+    if (
+        scaled and parse_processes != 1 and os.path.getsize(filename) >= PARALLEL_PARSE_MIN_BYTES
+        and get_statement_compression(filename) is None
+    ):
+        transactions = list(get_parallel_parsed_statement(filename, corporate_actions, parse_processes))
+        if any(previous.date > transaction.date for previous, transaction in zip(transactions, islice(transactions, 1, None))):
+            logging.error(f'{filename}: trade dates are not in order, statement is sorted before merging')
+            transactions.sort(key=attrgetter('date'))
+        return transactions
+    if is_statement_sorted(filename):
+        lines = iter_statement_lines(filename)
+    else:
+        logging.error(f'{filename}: trade dates are not in order, statement is sorted before merging')
+        lines = iter_externally_sorted_statement_lines(filename)
+    return iter_statement_transactions(filename, lines, corporate_actions, scaled=scaled)
+
+
+class ParseCache(object):
+    """Parsed, validated and split adjusted transactions of statements saved as TransactionColumns in directory.
+    Cache file name is digest of statement content, PARSER_VERSION and splits, so changed statement
+    is parsed again and files of old versions are never read.
+    """
+
+    def __init__(self, directory=PARSE_CACHE_DIRECTORY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_cache_filename(self, filename, corporate_actions):
+        settings = repr((PARSER_VERSION, sorted(corporate_actions.ordinals.items()), sorted(corporate_actions.multipliers.items())))
+        settings_digest = hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+        return os.path.join(self.directory, f'{get_file_fingerprint(filename)}.{settings_digest}.columns')
+
+    def get_columns(self, filename, corporate_actions=None, parse_processes=1):
+        """TransactionColumns of statement in chronological order, parsed only when not cached yet"""
+        corporate_actions = corporate_actions or default_corporate_actions
+        cache_filename = self.get_cache_filename(filename, corporate_actions)
+        if os.path.exists(cache_filename):
+            try:
+                columns, extra = TransactionColumns.load(cache_filename)
+            except (OSError, ValueError) as error:
+                logging.error(f'{cache_filename}: {error}, {filename} is parsed again')
+            else:
+                instrumentation.count('files_reused')
+                if extra['lines_skipped']:
+                    logging.error(f'{filename}: {extra["lines_skipped"]} wrong lines skipped, they were logged when it was parsed')
+                return columns
+        instrumentation.count('files_parsed')
+        lines_skipped = instrumentation.counters['lines_skipped']
+        columns = TransactionColumns.from_transactions(get_statement_transactions(filename, corporate_actions, parse_processes, scaled=True))
+        columns.save(cache_filename, lines_skipped=instrumentation.counters['lines_skipped'] - lines_skipped)
+        return columns
+
+
+def get_concatenated_columns(statements_columns):
+    """Columns of statements joined in chronological order, the same as merged transactions would be.
+    None when statements overlap and have to be merged transaction by transaction.
+    """
+    ordered = sorted(
+        ((columns.date_column[0], index, columns) for index, columns in enumerate(statements_columns) if len(columns)),
+        key=lambda item: item[:2],
+    )
+    concatenated = TransactionColumns()
+    previous_index = previous_last_ordinal = None
+    for first_ordinal, index, columns in ordered:
+        if previous_last_ordinal is not None and (
+            first_ordinal < previous_last_ordinal or (first_ordinal == previous_last_ordinal and index < previous_index)
+        ):
+            return None
+        concatenated.extend(columns)
+        previous_index, previous_last_ordinal = index, columns.date_column[-1]
+    return concatenated
+
+
+def iter_merged_transactions(filenames, corporate_actions=None, parse_processes=1, parse_cache=None, scaled=False):
+    """Yields transactions from all statements in chronological order, so they can overlap.
+    Transactions of the same date stay in order of files and lines.
+    With parse_cache, statements parsed before are read from it, they are always scaled.
+    """
+    corporate_actions = corporate_actions or default_corporate_actions
+    statements_transactions = []
+    for filename in filenames:
+        if parse_cache is not None:
+            statements_transactions.append(parse_cache.get_columns(filename, corporate_actions, parse_processes))
+        else:
+            statements_transactions.append(get_statement_transactions(filename, corporate_actions, parse_processes, scaled))
+    return heapq.merge(*statements_transactions, key=attrgetter('date'))
+
+
+def get_transactions(filenames, corporate_actions=None, parse_processes=1, parse_cache=None, scaled=False):
+    return list(iter_merged_transactions(filenames, corporate_actions, parse_processes, parse_cache, scaled))
+
+
+def get_transactions_currencies(transactions):
+    return {transaction.currency_code for transaction in transactions}
+
+
 def get_grouped_transactions(transactions):
     grouped_transactions = OrderedDict()
     for transaction in transactions:
@@ -267,14 +1157,443 @@ def get_grouped_transactions(transactions):
     return grouped_transactions
 
 
-def get_processed_single_group(key, transactions):
+class TransactionColumns(object):
+    """Compact columnar store of transactions for big inputs.
+    Every column is an array with one item per transaction: ticker, name and currency are ids of interned strings,
+    date is an ordinal, type is an index in Transaction.TRANSACTION_TYPES,
+    quantity, value and rate are integers scaled by QUANTITY_SCALE, VALUE_SCALE and RATE_SCALE.
+    Number of decimal places given in statement is kept for quantity and value, so they are restored exactly.
+    Transaction objects are created only when a group is processed.
+    Saved file is header, json with interned strings and every array column (native byte order).
+    """
+    ARRAY_COLUMNS = [
+        'ticker_column',
+        'name_column',
+        'currency_column',
+        'date_column',
+        'type_column',
+        'quantity_column',
+        'quantity_places_column',
+        'value_column',
+        'value_places_column',
+        'rate_column',
+    ]
+
+    def __init__(self):
+        self.tickers = []
+        self.ticker_ids = {}
+        self.names = []
+        self.name_ids = {}
+        self.currencies = []
+        self.currency_ids = {}
+        self.ticker_column = array('i')
+        self.name_column = array('i')
+        self.currency_column = array('b')
+        self.date_column = array('i')
+        self.type_column = array('b')
+        self.quantity_column = array('q')
+        self.quantity_places_column = array('b')
+        self.value_column = array('q')
+        self.value_places_column = array('b')
+        self.rate_column = array('q')
+
+    def __len__(self):
+        return len(self.date_column)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.get_transaction(row)
+
+    @classmethod
+    def from_transactions(cls, transactions):
+        columns = cls()
+        for transaction in transactions:
+            columns.append(transaction)
+        return columns
+
+    @classmethod
+    def load(cls, filename, parser_version=PARSER_VERSION):
+        """(columns, extra values saved with them)"""
+        with open(filename, 'rb') as file:
+            data = file.read()
+        magic, version, count, strings_length = TRANSACTION_COLUMNS_HEADER.unpack_from(data)
+        if magic != TRANSACTION_COLUMNS_MAGIC or version != parser_version:
+            raise ValueError(f'{filename} is not transaction columns of parser version {parser_version}')
+        offset = TRANSACTION_COLUMNS_HEADER.size
+        strings = json.loads(data[offset:offset + strings_length])
+        offset += strings_length
+        columns = cls()
+        for values_name, ids_name in (('tickers', 'ticker_ids'), ('names', 'name_ids'), ('currencies', 'currency_ids')):
+            values = strings.pop(values_name)
+            setattr(columns, values_name, values)
+            setattr(columns, ids_name, {value: value_id for value_id, value in enumerate(values)})
+        for column_name in cls.ARRAY_COLUMNS:
+            column = getattr(columns, column_name)
+            column.frombytes(data[offset:offset + count * column.itemsize])
+            offset += count * column.itemsize
+        if offset != len(data):
+            raise ValueError(f'{filename} is truncated')
+        return columns, strings
+
+    def save(self, filename, parser_version=PARSER_VERSION, **extra):
+        """Saved to temporary file first, so reader never sees half of it"""
+        strings = json.dumps(dict(extra, tickers=self.tickers, names=self.names, currencies=self.currencies)).encode()
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as file:
+            file.write(TRANSACTION_COLUMNS_HEADER.pack(TRANSACTION_COLUMNS_MAGIC, parser_version, len(self), len(strings)))
+            file.write(strings)
+            for column_name in self.ARRAY_COLUMNS:
+                file.write(getattr(self, column_name).tobytes())
+        os.replace(file.name, filename)
+
+    @staticmethod
+    def get_scaled_value(value, scale):
+        """(value scaled to integer, number of decimal places)"""
+        return get_scaled_integer(value, scale), max(-value.as_tuple().exponent, 0)
+
+    @staticmethod
+    def get_decimal_value(scaled_value, places, scale):
+        return decimal.Decimal(scaled_value // (scale // 10 ** places)).scaleb(-places)
+
+    def get_interned_id(self, ids, values, value):
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(values)
+            values.append(value)
+        return value_id
+
+    def append(self, transaction):
+        quantity, quantity_places = self.get_scaled_value(transaction.quantity_of_stocks, QUANTITY_SCALE)
+        value, value_places = self.get_scaled_value(transaction.value_usd, VALUE_SCALE)
+        self.ticker_column.append(self.get_interned_id(self.ticker_ids, self.tickers, transaction.entity_code))
+        self.name_column.append(self.get_interned_id(self.name_ids, self.names, transaction.entity_name))
+        self.currency_column.append(self.get_interned_id(self.currency_ids, self.currencies, transaction.currency_code))
+        self.date_column.append(transaction.date.toordinal())
+        self.type_column.append(Transaction.TRANSACTION_TYPES.index(transaction.transaction_type))
+        self.quantity_column.append(quantity)
+        self.quantity_places_column.append(quantity_places)
+        self.value_column.append(value)
+        self.value_places_column.append(value_places)
+        self.rate_column.append(0)
+
+    def extend(self, columns):
+        """Rows of other columns appended after rows of these, with ids of interned strings translated"""
+        for ids, values, column, other_values, other_column in (
+            (self.ticker_ids, self.tickers, self.ticker_column, columns.tickers, columns.ticker_column),
+            (self.name_ids, self.names, self.name_column, columns.names, columns.name_column),
+            (self.currency_ids, self.currencies, self.currency_column, columns.currencies, columns.currency_column),
+        ):
+            translated_ids = [self.get_interned_id(ids, values, value) for value in other_values]
+            column.extend(translated_ids[value_id] for value_id in other_column)
+        self.date_column.extend(columns.date_column)
+        self.type_column.extend(columns.type_column)
+        self.quantity_column.extend(columns.quantity_column)
+        self.quantity_places_column.extend(columns.quantity_places_column)
+        self.value_column.extend(columns.value_column)
+        self.value_places_column.extend(columns.value_places_column)
+        self.rate_column.extend(columns.rate_column)
+
+    def get_dates(self):
+        return {date.fromordinal(ordinal) for ordinal in set(self.date_column)}
+
+    def fill_rates(self, rate_tables):
+        """Rate of transaction currency from day before the transaction for every row.
+        Whole date column of each currency is joined with its rate table at once, when numpy is available.
+        """
+        numpy = get_numpy()
+        if numpy is not None:
+            ordinals = numpy.frombuffer(self.date_column, dtype=numpy.int32)
+            currency_ids = numpy.frombuffer(self.currency_column, dtype=numpy.int8)
+            rates = numpy.zeros(len(self), dtype=numpy.int64)
+            for currency_id, currency in enumerate(self.currencies):
+                if currency not in rate_tables:
+                    continue
+                rows = currency_ids == currency_id
+                rates[rows] = rate_tables[currency].get_scaled_rates_before(ordinals[rows])
+            self.rate_column = array('q', rates.tobytes())
+            return
+        currencies_rate_tables = [rate_tables.get(currency) for currency in self.currencies]
+        rates_of_dates = {}
+        for row, (ordinal, currency_id) in enumerate(zip(self.date_column, self.currency_column)):
+            rate = rates_of_dates.get((ordinal, currency_id))
+            if rate is None:
+                rate_table = currencies_rate_tables[currency_id]
+                rate = rate_table.get_scaled_rate_before(ordinal) if rate_table is not None else 0
+                rates_of_dates[(ordinal, currency_id)] = rate
+            self.rate_column[row] = rate
+
+    def get_transaction(self, row):
+        rate = self.rate_column[row]
+        transaction = Transaction.from_values(
+            self.tickers[self.ticker_column[row]],
+            self.names[self.name_column[row]],
+            Transaction.TRANSACTION_TYPES[self.type_column[row]],
+            date.fromordinal(self.date_column[row]),
+            self.get_decimal_value(self.value_column[row], self.value_places_column[row], VALUE_SCALE),
+            self.get_decimal_value(self.quantity_column[row], self.quantity_places_column[row], QUANTITY_SCALE),
+            decimal.Decimal(rate) / RATE_SCALE if rate else None,
+            self.currencies[self.currency_column[row]],
+        )
+        transaction.scaled_quantity = self.quantity_column[row]
+        transaction.scaled_value = self.value_column[row]
+        transaction.scaled_rate = rate or None
+        if rate:
+            transaction.count_pln_value()
+        return transaction
+
+    def get_grouped_transactions(self, rated_currencies):
+        """{ticker: rows of the ticker} in order of first appearance, read straight from ticker column.
+        Rows without rate are checked like in get_priced_transactions.
+        """
+        grouped_rows = OrderedDict()
+        for row, (ticker_id, rate) in enumerate(zip(self.ticker_column, self.rate_column)):
+            if not rate:
+                skip_transaction_without_rate(self.get_transaction(row), rated_currencies)
+                continue
+            rows = grouped_rows.get(ticker_id)
+            if rows is None:
+                rows = grouped_rows[ticker_id] = array('i')
+            rows.append(row)
+        return OrderedDict(
+            (self.tickers[ticker_id], TransactionColumnsGroup(self, rows)) for ticker_id, rows in grouped_rows.items()
+        )
+
+
+class TransactionColumnsGroup(object):
+    """Transactions of single ticker, created from columns when iterated"""
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.columns.get_transaction(row)
+
+    def get_transaction(self, position):
+        return self.columns.get_transaction(self.rows[position])
+
+    def get_fixed_point_rows(self):
+        """Same as get_fixed_point_rows, but read straight from columns, without transactions"""
+        columns = self.columns
+        rows = []
+        for row in self.rows:
+            rate = columns.rate_column[row]
+            if not rate:
+                raise ValueError(f'no price for {columns.get_transaction(row)}')
+            rows.append((
+                None,
+                Transaction.TRANSACTION_TYPES[columns.type_column[row]],
+                columns.quantity_column[row],
+                columns.value_column[row],
+                rate,
+            ))
+        return rows
+
+    def __reduce__(self):
+        # only transactions of the group are sent to worker process, not all columns
+        return list, (list(self),)
+
+
+def get_lot_str(transaction, quantity):
+    return str({'transaction': transaction, 'quantity': quantity})
+
+
+class Lot(object):
+    """Transaction with quantity of stocks which is not matched yet"""
+    __slots__ = ('index', 'transaction', 'quantity')
+
+    def __init__(self, index, transaction, quantity):
+        self.index = index
+        self.transaction = transaction
+        self.quantity = quantity
+
+    def __str__(self):
+        return get_lot_str(self.transaction, self.quantity)
+
+
+class LotMatcher(abc.ABC):
+    """Strategy choosing which of open BUY lots is sold first"""
+
+    @abc.abstractmethod
+    def add_lot(self, lot):
+        """Lot which can be sold from now on"""
+
+    @abc.abstractmethod
+    def get_next_lot(self):
+        """Open lot which should be sold first, None when everything is sold"""
+
+    @abc.abstractmethod
+    def get_open_lots(self):
+        """Lots with quantity left, in order they would be sold"""
+
+
+class FifoLotMatcher(LotMatcher):
+    """Lots are sold in order they were bought.
+    Head of the queue only moves forward, so matching whole group is O(n).
+    """
+
+    def __init__(self):
+        self.lots = []
+        self.head = 0
+
+    def add_lot(self, lot):
+        self.lots.append(lot)
+
+    def get_next_lot(self):
+        while self.head < len(self.lots) and self.lots[self.head].quantity == 0:
+            self.head += 1
+        if self.head == len(self.lots):
+            return None
+        return self.lots[self.head]
+
+    def get_open_lots(self):
+        return [lot for lot in self.lots[self.head:] if lot.quantity != 0]
+
+
+LOT_MATCHERS = {
+    'fifo': FifoLotMatcher,
+}
+LOT_MATCHING_STRATEGY = 'fifo'
+
+VERBOSITY_NONE = 0  # nothing is recorded, only results are counted
+VERBOSITY_REPORT = 1  # audit events are recorded for output.csv
+VERBOSITY_LOGS = 2  # audit of every group is printed as well
+VERBOSITY = VERBOSITY_REPORT
+
+PROCESSES = 1  # worker processes matching groups, 0 means one per cpu
+ARITHMETIC = 'decimal'  # one of GROUP_PROCESSORS
+FIXED_POINT_CHECKED_KEYS = ['income', 'cost', 'stocks_left', 'income_div', 'cost_div']
+FIXED_POINT_TOLERANCE = decimal.Decimal('0.005')  # results have to be the same in grosz
+BATCH_MIN_TRANSACTIONS = 1000  # small groups are sent to workers together
+
+AUDIT_SELL = 'SELL'
+AUDIT_LOT = 'LOT'  # part of sell matched with part of buy lot
+AUDIT_SELL_CLOSED = 'SELL_CLOSED'
+AUDIT_DIV = 'DIV'
+AUDIT_DIVNRA = 'DIVNRA'
+AUDIT_SUMMARY = 'SUMMARY'
+# quantity is quantity of the transaction at the moment of event (matched quantity for LOT events),
+# lot_index is index of the lot in its group, the same as index of Lot in open_lots of the result
+AuditEvent = namedtuple(
+    'AuditEvent',
+    ['event_type', 'transaction', 'quantity', 'lot_transaction', 'lot_quantity', 'income', 'cost', 'result', 'lot_index'],
+    defaults=[None, None, None, None, None, None, None, None],
+)
+
+
+def get_audit_lines(events):
+    """Render audit events of single group into report lines"""
+    lines = []
+    profits_for_report = []
+    for event in events:
+        transaction = event.transaction
+        if event.event_type == AUDIT_SELL:
+            profits_for_report = []
+            lines.append('')
+            lines.append(get_lot_str(transaction, event.quantity))
+        elif event.event_type == AUDIT_LOT:
+            lot_transaction = event.lot_transaction
+            lines.append(get_lot_str(lot_transaction, event.lot_quantity))
+            lines.append(f'income: {transaction.usd_price_in_given_date} * {event.quantity} * {transaction.single_stock_price} = {round(event.income, 4)}')
+            lines.append(f'cost: {lot_transaction.usd_price_in_given_date} * {event.quantity} * {lot_transaction.single_stock_price} = {round(event.cost, 4)}')
+            lines.append(f'profit: {event.income} - {event.cost} = {round(event.income - event.cost, 4)}')
+            profits_for_report.append(str(event.income - event.cost))
+        elif event.event_type == AUDIT_SELL_CLOSED:
+            lines.append('profit for sell: ' + ' + '.join(profits_for_report) + f' = {event.income - event.cost}')
+        elif event.event_type == AUDIT_DIV:
+            lines.append(get_lot_str(transaction, event.quantity))
+            lines.append(f'DIV {transaction.value_pln}')
+        elif event.event_type == AUDIT_DIVNRA:
+            lines.append(get_lot_str(transaction, event.quantity))
+            lines.append(f'* DIVNRA {transaction.value_pln}')
+        elif event.event_type == AUDIT_SUMMARY:
+            result = event.result
+            lines.append(
+                f'[{result["key"]}] profit_stocks: {result["profit"]}, income_stocks: {result["income"]}, cost_stocks: {result["cost"]}, '
+                f'income_div: {result["income_div"]}, cost_div: {result["cost_div"]}, profit_div: {result["profit_div"]}, '
+                f'cost_total: {result["cost_total"]}, income_total: {result["income_total"]}, profit_stocks: {result["profit_total"]}'
+            )
+    return lines
+
+
+LEDGER_COLUMNS = [
+    'key',
+    'event',
+    'date',
+    'currency',
+    'quantity',
+    'price_usd',
+    'rate',
+    'lot_date',
+    'lot_quantity',
+    'lot_price_usd',
+    'lot_rate',
+    'income_pln',
+    'cost_pln',
+    'profit_pln',
+]
+
+
+def iter_ledger_rows(key, events):
+    """Rows of LEDGER_COLUMNS, one per lot matched with a sell and one per dividend"""
+    for event in events:
+        transaction = event.transaction
+        if event.event_type == AUDIT_LOT:
+            lot_transaction = event.lot_transaction
+            yield (
+                key, event.event_type, transaction.date, transaction.currency_code, event.quantity, transaction.single_stock_price,
+                transaction.usd_price_in_given_date, lot_transaction.date, event.lot_quantity,
+                lot_transaction.single_stock_price, lot_transaction.usd_price_in_given_date,
+                event.income, event.cost, event.income - event.cost,
+            )
+        elif event.event_type == AUDIT_DIV:
+            yield (
+                key, event.event_type, transaction.date, transaction.currency_code, event.quantity, None, transaction.usd_price_in_given_date,
+                None, None, None, None, transaction.value_pln, None, transaction.value_pln,
+            )
+        elif event.event_type == AUDIT_DIVNRA:
+            yield (
+                key, event.event_type, transaction.date, transaction.currency_code, event.quantity, None, transaction.usd_price_in_given_date,
+                None, None, None, None, None, transaction.value_pln, -transaction.value_pln,
+            )
+
+
+def write_ledger_csv(file, groups_events):
+    writer = csv.writer(file)
+    writer.writerow(LEDGER_COLUMNS)
+    for key, events in groups_events:
+        writer.writerows(iter_ledger_rows(key, events))
+
+
+def write_ledger_jsonl(file, groups_events):
+    encoder = json.JSONEncoder(default=str)
+    for key, events in groups_events:
+        for row in iter_ledger_rows(key, events):
+            file.write(encoder.encode(dict(zip(LEDGER_COLUMNS, row))))
+            file.write('\n')
+
+
+LEDGER_WRITERS = {
+    'csv': write_ledger_csv,
+    'jsonl': write_ledger_jsonl,
+}
+
+
+def count_group_totals(return_value):
+    # count profit
+    return_value['profit'] = return_value['income'] - return_value['cost']
+    return_value['income_total'] = return_value['income_div'] + return_value['income']
+    return_value['profit_div'] = return_value['income_div'] - return_value['cost_div']
+    return_value['profit_total'] = return_value['profit'] + return_value['profit_div']
+    return_value['cost_total'] = return_value['cost'] + return_value.get('cost_div')
+
+
+def get_processed_single_group(key, transactions, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, opening_lots=()):
     # pln
-    KEYS_TO_SKIP = ['BYND', 'BA', 'INTC', 'NIO', 'SPWR', 'KOS', 'HGV', 'MUR', 'DIS', 'AMD', 'FB']
-    if not DEBUG:
-        KEYS_TO_SKIP = []
-    print_logs = []
-    print_logs.append(f'\n\n!!!!!!!!!!!!!!!!!!!!!!! processing {key} !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-    PRINT_LOGS = True
     return_value = {
         'key': key,
         'income': decimal.Decimal(0.0),
@@ -284,199 +1603,436 @@ def get_processed_single_group(key, transactions):
         'income_div': decimal.Decimal(0.0),
         'cost_div': decimal.Decimal(0.0),
         'profit_total': decimal.Decimal(0.0),
+        'lots_matched': 0,
     }
-    report_operations[return_value.get('key')] = []
+    events = [] if verbosity >= VERBOSITY_REPORT else None
     group_managed = [
-        {'transaction': val, 'quantity': val.quantity_of_stocks} for val in transactions
+        Lot(index, val, quantity) for index, (val, quantity) in enumerate(chain(
+            opening_lots, ((val, val.quantity_of_stocks) for val in transactions)
+        ))
     ]
     if 'HGV' not in key and DEBUG:
-        return
+        return None, None
+    # every BUY is open from the start, as sell may be listed before the buy it closes
+    lot_matcher = LOT_MATCHERS[lot_matching_strategy]()
     for g in group_managed:
-        print_logs.append(str(g))
-    print_logs.append('===============')
-    for index, entityA in enumerate(group_managed):
-        transaction = entityA.get('transaction')
+        if g.transaction.transaction_type == 'BUY' and g.quantity > 0:
+            lot_matcher.add_lot(g)
+    for entityA in group_managed:
+        transaction = entityA.transaction
         # DIV
         if transaction.transaction_type == 'DIV':
-            report_operations[return_value.get('key')].append(str(entityA))
-            report_operations[return_value.get('key')].append(
-                f'DIV {transaction.value_pln}'
-            )
-            updated_div = return_value.get('income_div') + transaction.value_pln
-            income_div_before = return_value.get('income_div')
-
-            print_logs.append(str(entityA))
-            print_logs.append(f'* DIV: {income_div_before} + {transaction.value_pln} -> {updated_div}')
-
-            return_value['income_div'] = updated_div
+            if events is not None:
+                events.append(AuditEvent(AUDIT_DIV, transaction, entityA.quantity))
+            return_value['income_div'] = return_value.get('income_div') + transaction.value_pln
         # DIVNRA
         if transaction.transaction_type == 'DIVNRA':
-            report_operations[return_value.get('key')].append(str(entityA))
-            report_operations[return_value.get('key')].append(
-                f'* DIVNRA {transaction.value_pln}'
-            )
-            updated_cost_div = return_value.get('cost_div') + transaction.value_pln
-            cost_div_before = return_value.get('cost_div')
-
-            print_logs.append(str(entityA))
-            print_logs.append(f'DIVNRA: {cost_div_before} + {transaction.value_pln} -> {updated_cost_div}')
-
-            return_value['cost_div'] = updated_cost_div
+            if events is not None:
+                events.append(AuditEvent(AUDIT_DIVNRA, transaction, entityA.quantity))
+            return_value['cost_div'] = return_value.get('cost_div') + transaction.value_pln
         # SELL
         if transaction.transaction_type == 'SELL':
-            if DEBUG:
-                print_logs.append(f'SELL{index}{entityA}')
-            profits_for_report = []
             pre_income = return_value.get('income')
             pre_cost = return_value.get('cost')
-            report_operations[return_value.get('key')].append('')
-            report_operations[return_value.get('key')].append(str(entityA))
+            if events is not None:
+                events.append(AuditEvent(AUDIT_SELL, transaction, entityA.quantity))
 
             amount_to_subtract = abs(transaction.quantity_of_stocks)  # it is x < 0
-            for index_b, entityB in enumerate(group_managed):
-                transactionB = entityB.get('transaction')
-
-                if transactionB.transaction_type == 'BUY' and DEBUG:
-                    print_logs.append(f'{index}.{index_b} {entityB}')
-
-                if transactionB.transaction_type == 'BUY' and entityB.get('quantity') != 0:
-                    report_operations[return_value.get('key')].append(str(entityB))
-                    diff = entityB.get('quantity') - abs(amount_to_subtract)
-                    q = entityB.get('quantity')
-                    if DEBUG:
-                        print_logs.append(f'{diff} = {q} - {abs(amount_to_subtract)}')
-
-                    print_logs.append(f'{index}.{index_b}')
-                    print_logs.append(str(entityA))
-                    print_logs.append(str(entityB))
-
-                    if diff < 0 and DEBUG:
-                        print_logs.append(f'{index_b}{entityB}')
-                    # import pdb; pdb.set_trace()
-                    if diff < 0:
-                        # sell more stocks than in this transaction buy
-                        updated_entity_A_quantity = diff
-                        updated_entity_B_quantity = 0
-
-                        stocks_amount_in_B_transaction = entityB.get('quantity')
-                        cost_of_this_transaction = transactionB.get_value_pln_for_given_amount_of_stocks(stocks_amount_in_B_transaction)
-                        cost_of_this_transaction_report = f'cost: {transactionB.usd_price_in_given_date} * {abs(stocks_amount_in_B_transaction)} * {transactionB.single_stock_price} = {round(cost_of_this_transaction, 4)}'
-
-                        income_of_this_transaction = transaction.get_value_pln_for_given_amount_of_stocks(stocks_amount_in_B_transaction)
-                        income_of_this_transaction_report = f'income: {transaction.usd_price_in_given_date} * {abs(stocks_amount_in_B_transaction)} * {transaction.single_stock_price} = {round(income_of_this_transaction, 4)}'
-
-                        amount_to_subtract = diff
-                    elif diff == 0:
-                        updated_entity_A_quantity = 0
-                        updated_entity_B_quantity = 0
-
-                        cost_of_this_transaction = transactionB.get_value_pln_for_given_amount_of_stocks(amount_to_subtract)
-                        cost_of_this_transaction_report = f'cost: {transactionB.usd_price_in_given_date} * {abs(amount_to_subtract)} * {transactionB.single_stock_price} = {round(cost_of_this_transaction, 4)}'
-
-                        income_of_this_transaction = transaction.get_value_pln_for_given_amount_of_stocks(amount_to_subtract)
-                        income_of_this_transaction_report = f'income: {transaction.usd_price_in_given_date} * {abs(amount_to_subtract)} * {transaction.single_stock_price} = {round(income_of_this_transaction, 4)}'
-                    else:
-                        updated_entity_A_quantity = 0
-                        updated_entity_B_quantity = diff
-
-                        cost_of_this_transaction = transactionB.get_value_pln_for_given_amount_of_stocks(amount_to_subtract)
-                        cost_of_this_transaction_report = f'cost: {transactionB.usd_price_in_given_date} * {abs(amount_to_subtract)} * {transactionB.single_stock_price} = {round(cost_of_this_transaction, 4)}'
-
-                        income_of_this_transaction = transaction.get_value_pln_for_given_amount_of_stocks(amount_to_subtract)
-                        income_of_this_transaction_report = f'income: {transaction.usd_price_in_given_date} * {abs(amount_to_subtract)} * {transaction.single_stock_price} = {round(income_of_this_transaction, 4)}'
-
-                    updated_income = return_value.get('income') + income_of_this_transaction
-                    cost_updated = return_value.get('cost') + cost_of_this_transaction
-
-                    income = return_value.get('income')
-                    cost = return_value.get('cost')
-
-                    print_logs.append((
-                        f'* income_of_this_transaction: {income_of_this_transaction}: {income} -> {updated_income}'
-                        f'\n* cost_of_this_transaction: {cost_of_this_transaction}: {cost} -> {cost_updated}'
-                        f'\n* profit (general + this) {income - cost} +  {income_of_this_transaction - cost_of_this_transaction} -> {updated_income - cost_updated}'
+            entityB = lot_matcher.get_next_lot()
+            while entityB is not None:
+                transactionB = entityB.transaction
+                stocks_amount_in_B_transaction = entityB.quantity
+                diff = stocks_amount_in_B_transaction - amount_to_subtract
+                if diff < 0:
+                    # sell more stocks than in this transaction buy
+                    stocks_amount = stocks_amount_in_B_transaction
+                    amount_to_subtract = -diff
+                    entityA.quantity = diff
+                    entityB.quantity = 0
+                else:
+                    stocks_amount = amount_to_subtract
+                    entityA.quantity = 0
+                    entityB.quantity = diff
+
+                cost_of_this_transaction = transactionB.get_value_pln_for_given_amount_of_stocks(stocks_amount)
+                income_of_this_transaction = transaction.get_value_pln_for_given_amount_of_stocks(stocks_amount)
+                return_value['income'] = return_value.get('income') + income_of_this_transaction
+                return_value['cost'] = return_value.get('cost') + cost_of_this_transaction
+                return_value['lots_matched'] += 1
+                if events is not None:
+                    events.append(AuditEvent(
+                        AUDIT_LOT, transaction, stocks_amount, transactionB, stocks_amount_in_B_transaction,
+                        income_of_this_transaction, cost_of_this_transaction, lot_index=entityB.index,
                     ))
 
-                    profit_report = f'profit: {income_of_this_transaction} - {cost_of_this_transaction} = {round(income_of_this_transaction - cost_of_this_transaction, 4)}'
-                    entityA['quantity'] = updated_entity_A_quantity
-                    entityB['quantity'] = updated_entity_B_quantity
+                if diff >= 0:
+                    if events is not None:
+                        events.append(AuditEvent(
+                            AUDIT_SELL_CLOSED, transaction, 0,
+                            income=return_value.get('income') - pre_income,
+                            cost=return_value.get('cost') - pre_cost,
+                        ))
+                    break
+                entityB = lot_matcher.get_next_lot()
+    # count stocks left
+    stocks_left = sum([group.quantity for group in group_managed])
+    return_value['stocks_left'] = stocks_left
+    return_value['open_lots'] = lot_matcher.get_open_lots()
+    count_group_totals(return_value)
 
-                    print_logs.append(str(entityA))
-                    print_logs.append(str(entityB))
+    if events is not None:
+        events.append(AuditEvent(AUDIT_SUMMARY, result=dict(return_value)))
+    return return_value, events
 
-                    return_value['income'] = updated_income
-                    return_value['cost'] = cost_updated
-                    # report
-                    report_operations[return_value.get('key')].append(income_of_this_transaction_report)
-                    report_operations[return_value.get('key')].append(cost_of_this_transaction_report)
-                    report_operations[return_value.get('key')].append(profit_report)
-                    profits_for_report.append(str(income_of_this_transaction - cost_of_this_transaction))
 
-                    if diff >= 0:
-                        transaction_profit = (updated_income - pre_income) - (cost_updated - pre_cost)
-                        transaction_profit_report = 'profit for sell: ' + ' + '.join(profits_for_report) + f' = {transaction_profit}'
-                        report_operations[return_value.get('key')].append(transaction_profit_report)
+def get_rounded_division(numerator, denominator):
+    """numerator / denominator rounded half to even, like decimal context does"""
+    quotient, remainder = divmod(numerator, denominator)
+    doubled_remainder = 2 * remainder
+    if doubled_remainder > denominator or (doubled_remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
 
-                        print_logs.append(f'whole sell transaction {index} profit: {transaction_profit}')
-                        break
-    # count stocks left
-    stocks_left = sum([group.get('quantity') for group in group_managed])
-    return_value['stocks_left'] = stocks_left
-    # count profit
-    return_value['profit'] = return_value['income'] - return_value['cost']
-    return_value['income_total'] = return_value['income_div'] + return_value['income']
-    return_value['profit_div'] = return_value['income_div'] - return_value['cost_div']
-    return_value['profit_total'] = return_value['profit'] + return_value['profit_div']
-    return_value['cost_total'] = return_value['cost'] + return_value.get('cost_div')
 
-    key = return_value.get('key')
-    profit = return_value.get('profit')
-    income = return_value.get('income')
-    cost = return_value.get('cost')
-    income_div = return_value['income_div']
-    profit_div = return_value['profit_div']
-    cost_div = return_value.get('cost_div')
-    cost_total = return_value.get('cost_total')
-    profit_total = return_value.get('profit_total')
-    income_total = return_value['income_total']
-    report_operations[return_value.get('key')].append(
-        f'[{key}] profit_stocks: {profit}, income_stocks: {income}, cost_stocks: {cost}, income_div: {income_div}, cost_div: {cost_div}, profit_div: {profit_div}, cost_total: {cost_total}, income_total: {income_total}, profit_stocks: {profit_total}'
-    )
+def get_fixed_point_rows(transactions, with_transactions=True):
+    """[(transaction, type, quantity, value, rate), ...] with integers scaled by QUANTITY_SCALE, VALUE_SCALE and RATE_SCALE.
+    Rows of columnar store are read without creating transactions, when they are not needed.
+    Values scaled when statement was parsed and rates were filled are used as they are, the rest is scaled here.
+    """
+    if isinstance(transactions, TransactionColumnsGroup) and not with_transactions:
+        return transactions.get_fixed_point_rows()
+    rows = []
+    for transaction in transactions:
+        if transaction.usd_price_in_given_date is None:
+            raise ValueError(f'no price for {transaction}')
+        quantity = transaction.scaled_quantity
+        if quantity is None:
+            quantity = get_scaled_integer(transaction.quantity_of_stocks, QUANTITY_SCALE)
+        value = transaction.scaled_value
+        if value is None:
+            value = get_scaled_integer(transaction.value_usd, VALUE_SCALE)
+        rate = transaction.scaled_rate
+        if rate is None:
+            rate = get_scaled_integer(transaction.usd_price_in_given_date, RATE_SCALE)
+        rows.append((transaction, transaction.transaction_type, quantity, value, rate))
+    return rows
+
+
+def get_processed_single_group_fixed_point(key, transactions, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, opening_lots=()):
+    """Same as get_processed_single_group, but counted on scaled integers.
+    Value in pln of whole transaction (rate * value) is exact in PLN_SCALE,
+    the only rounding point is value of the part of transaction matched with a lot.
+    """
+    events = [] if verbosity >= VERBOSITY_REPORT else None
+    rows = get_fixed_point_rows(transactions, events is not None)
+    income = cost = income_div = cost_div = lots_matched = 0
+    quantities = []
+    values_pln = []
+    group_managed = []
+    lot_matcher = LOT_MATCHERS[lot_matching_strategy]()
+    for index, (transaction, quantity_left) in enumerate(opening_lots):
+        _, _, quantity, value, rate = get_fixed_point_rows([transaction])[0]
+        quantities.append(abs(quantity))
+        values_pln.append(rate * value)
+        lot = Lot(index, transaction, get_scaled_integer(quantity_left, QUANTITY_SCALE))
+        group_managed.append(lot)
+        lot_matcher.add_lot(lot)
+    for index, (transaction, transaction_type, quantity, value, rate) in enumerate(rows, len(opening_lots)):
+        quantities.append(abs(quantity))
+        values_pln.append(rate * value)
+        lot = Lot(index, transaction, quantity)
+        group_managed.append(lot)
+        # every BUY is open from the start, as sell may be listed before the buy it closes
+        if transaction_type == 'BUY' and quantity > 0:
+            lot_matcher.add_lot(lot)
+    for entityA, (transaction, transaction_type, quantity, value, rate) in zip(group_managed[len(opening_lots):], rows):
+        if transaction_type == 'DIV':
+            if events is not None:
+                events.append(AuditEvent(AUDIT_DIV, transaction, transaction.quantity_of_stocks))
+            income_div += values_pln[entityA.index]
+        elif transaction_type == 'DIVNRA':
+            if events is not None:
+                events.append(AuditEvent(AUDIT_DIVNRA, transaction, transaction.quantity_of_stocks))
+            cost_div += values_pln[entityA.index]
+        elif transaction_type == 'SELL':
+            pre_income = income
+            pre_cost = cost
+            if events is not None:
+                events.append(AuditEvent(AUDIT_SELL, transaction, transaction.quantity_of_stocks))
+            sell_value_pln = abs(values_pln[entityA.index])
+            amount_to_subtract = abs(quantity)
+            entityB = lot_matcher.get_next_lot()
+            while entityB is not None:
+                stocks_amount_in_B_transaction = entityB.quantity
+                diff = stocks_amount_in_B_transaction - amount_to_subtract
+                if diff < 0:
+                    stocks_amount = stocks_amount_in_B_transaction
+                    amount_to_subtract = -diff
+                    entityA.quantity = diff
+                    entityB.quantity = 0
+                else:
+                    stocks_amount = amount_to_subtract
+                    entityA.quantity = 0
+                    entityB.quantity = diff
+                cost_of_this_transaction = get_rounded_division(
+                    stocks_amount * abs(values_pln[entityB.index]), quantities[entityB.index],
+                )
+                income_of_this_transaction = get_rounded_division(
+                    stocks_amount * sell_value_pln, quantities[entityA.index],
+                )
+                income += income_of_this_transaction
+                cost += cost_of_this_transaction
+                lots_matched += 1
+                if events is not None:
+                    events.append(AuditEvent(
+                        AUDIT_LOT, transaction, get_fixed_point_decimal(stocks_amount, QUANTITY_SCALE),
+                        entityB.transaction, get_fixed_point_decimal(stocks_amount_in_B_transaction, QUANTITY_SCALE),
+                        get_fixed_point_decimal(income_of_this_transaction, PLN_SCALE),
+                        get_fixed_point_decimal(cost_of_this_transaction, PLN_SCALE), lot_index=entityB.index,
+                    ))
+                if diff >= 0:
+                    if events is not None:
+                        events.append(AuditEvent(
+                            AUDIT_SELL_CLOSED, transaction, 0,
+                            income=get_fixed_point_decimal(income - pre_income, PLN_SCALE),
+                            cost=get_fixed_point_decimal(cost - pre_cost, PLN_SCALE),
+                        ))
+                    break
+                entityB = lot_matcher.get_next_lot()
+    return_value = {
+        'key': key,
+        'income': get_fixed_point_decimal(income, PLN_SCALE),
+        'cost': get_fixed_point_decimal(cost, PLN_SCALE),
+        'stocks_left': get_fixed_point_decimal(sum(lot.quantity for lot in group_managed), QUANTITY_SCALE),
+        'income_div': get_fixed_point_decimal(income_div, PLN_SCALE),
+        'cost_div': get_fixed_point_decimal(cost_div, PLN_SCALE),
+        'open_lots': [],
+        'lots_matched': lots_matched,
+    }
+    for lot in lot_matcher.get_open_lots():
+        transaction = lot.transaction
+        if transaction is None:
+            transaction = transactions.get_transaction(lot.index - len(opening_lots))
+        return_value['open_lots'].append(Lot(lot.index, transaction, get_fixed_point_decimal(lot.quantity, QUANTITY_SCALE)))
+    count_group_totals(return_value)
+    if events is not None:
+        events.append(AuditEvent(AUDIT_SUMMARY, result=dict(return_value)))
+    return return_value, events
+
+
+def get_processed_single_group_checked(key, transactions, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, opening_lots=()):
+    """Decimal result, checked against fixed point one"""
+    transactions = list(transactions)
+    return_value, events = get_processed_single_group(key, transactions, lot_matching_strategy, verbosity, opening_lots)
+    fixed_point_return_value, _ = get_processed_single_group_fixed_point(key, transactions, lot_matching_strategy, VERBOSITY_NONE, opening_lots)
+    if return_value is not None:
+        for result_key in FIXED_POINT_CHECKED_KEYS:
+            difference = abs(return_value[result_key] - fixed_point_return_value[result_key])
+            if difference >= FIXED_POINT_TOLERANCE:
+                logging.error(
+                    f'[{key}] {result_key} differs: decimal {return_value[result_key]}, fixed point {fixed_point_return_value[result_key]}'
+                )
+    return return_value, events
 
-    print_logs.append('\n       --return_value--\n')
-    print_logs.append(str(return_value))
-    if stocks_left < 0 and DEBUG:
-        print_logs.append('\n! WARNING ! WARNING ! WARNING ! WARNING ! WARNING ! WARNING ! WARNING ! => STOCKS TOO FEW\n')
 
-    if stocks_left > 0 and DEBUG:
-        print_logs.append('\n! WARNING ! WARNING ! WARNING ! WARNING ! WARNING ! WARNING ! WARNING ! => STOCKS LEFT\n')
+GROUP_PROCESSORS = {
+    'decimal': get_processed_single_group,
+    'fixed_point': get_processed_single_group_fixed_point,
+    'fixed_point_checked': get_processed_single_group_checked,
+}
+SCALED_ARITHMETICS = ['fixed_point', 'fixed_point_checked']  # transactions are parsed with scaled values for them
 
-    print_logs.append('       --return_value END--')
 
-    if PRINT_LOGS and key not in KEYS_TO_SKIP:
-        for log in print_logs:
-            print(log)
-    return return_value
+def get_processed_groups_batch(batch, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, arithmetic=ARITHMETIC):
+    """Worker of process pool, [(key, transactions, opening lots), ...] -> [(result, audit events), ...]"""
+    process_group = GROUP_PROCESSORS[arithmetic]
+    return [
+        process_group(key, transactions, lot_matching_strategy, verbosity, opening_lots)
+        for key, transactions, opening_lots in batch
+    ]
+
+
+def get_groups_batches(groups, batch_size):
+    """Consecutive groups joined into batches of at least batch_size transactions"""
+    batches = [[]]
+    transactions_in_batch = 0
+    for key, group, opening_lots in groups:
+        if transactions_in_batch >= batch_size:
+            batches.append([])
+            transactions_in_batch = 0
+        batches[-1].append((key, group, opening_lots))
+        transactions_in_batch += len(group) + len(opening_lots)
+    return batches
+
+
+def get_processed_groups(groups, processes=PROCESSES, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, arithmetic=ARITHMETIC):
+    """[(key, transactions, opening lots), ...] -> [(result, audit events), ...] in order of groups"""
+    instrumentation.count('groups_matched', len(groups))
+    if processes == 1 or len(groups) < 2:
+        processed = get_processed_groups_batch(groups, lot_matching_strategy, verbosity, arithmetic)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes or None) as executor:
+            batches = get_groups_batches(groups, BATCH_MIN_TRANSACTIONS)
+            processed = []
+            for batch_processed in executor.map(
+                partial(get_processed_groups_batch, lot_matching_strategy=lot_matching_strategy, verbosity=verbosity, arithmetic=arithmetic),
+                batches,
+            ):
+                processed.extend(batch_processed)
+    count_lots_matched(processed)
+    return processed
+
+
+def count_lots_matched(processed):
+    """Counted only for groups processed in this run, not for results reused from IncrementalCache"""
+    instrumentation.count('lots_matched', sum(result.get('lots_matched') for result, _ in processed if result))
+
+
+def get_processed_transactions_result(grouped_transactions, processes=PROCESSES, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, arithmetic=ARITHMETIC, opening_lots=None, incremental_cache=None, report_operations=None):
+    """Groups are independent, so they can be processed by pool of worker processes.
+    Results and audit are merged in order of groups, so output is the same as from serial run.
+    opening_lots: {key: [(transaction, quantity left), ...]} from checkpoint of previous period
+    incremental_cache: IncrementalCache, only groups changed since previous run are processed
+    report_operations: {key: audit events} filled for report
+    """
+    opening_lots = opening_lots or {}
+    keys = list(opening_lots) + [key for key in grouped_transactions if key not in opening_lots]
+    groups = [(key, grouped_transactions.get(key, []), opening_lots.get(key, [])) for key in keys]
+    if incremental_cache is None:
+        processed = get_processed_groups(groups, processes, lot_matching_strategy, verbosity, arithmetic)
+    else:
+        processed = incremental_cache.get_processed_groups(groups, processes, lot_matching_strategy, verbosity, arithmetic)
+    return get_merged_processed_groups(keys, processed, verbosity, report_operations)
 
 
-def get_processed_transactions_result(grouped_transactions):
+def get_merged_processed_groups(keys, processed, verbosity=VERBOSITY, report_operations=None):
+    """Results of groups in order of keys, audit events are put into report_operations"""
     processed_groups = []
-    for key, group in grouped_transactions.items():
-        processed_group = get_processed_single_group(key, group)
+    for key, (processed_group, events) in zip(keys, processed):
+        if events is not None:
+            if report_operations is not None:
+                report_operations[key] = events
+            if verbosity >= VERBOSITY_LOGS:
+                print(f'\n\n!!!!!!!!!!!!!!!!!!!!!!! processing {key} !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+                for line in get_audit_lines(events):
+                    print(line)
         processed_groups.append(processed_group)
     return processed_groups
 
 
+def get_file_fingerprint(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as file:
+        for chunk in iter(partial(file.read, 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_group_fingerprint(group, opening_lots, *settings):
+    """Digest of everything result of the group depends on"""
+    digest = hashlib.blake2b(repr(settings).encode(), digest_size=16)
+    for transaction, quantity_left in chain(opening_lots, ((transaction, None) for transaction in group)):
+        digest.update(repr((
+            transaction.transaction_type, transaction.date, transaction.currency_code, transaction.quantity_of_stocks,
+            transaction.value_usd, transaction.usd_price_in_given_date, transaction.value_pln, quantity_left,
+        )).encode())
+    return digest.hexdigest()
+
+
+class IncrementalCache(object):
+    """Parsed statements and group results of previous runs.
+    Statement is parsed again only when its content changed, group is processed again only when
+    its transactions, opening lots or processing settings changed.
+    """
+
+    def __init__(self):
+        self.files = {}  # filename: (fingerprint, transactions)
+        self.parse_settings = None  # splits and scaling statements were parsed with
+        self.groups = {}  # key: (fingerprint, (result, audit events))
+
+    def get_transactions(self, filenames, corporate_actions=None, scaled=False):
+        corporate_actions = corporate_actions or default_corporate_actions
+        parse_settings = (corporate_actions.ordinals, corporate_actions.multipliers, scaled)
+        if parse_settings != self.parse_settings:
+            self.files.clear()
+            self.parse_settings = parse_settings
+        statements_transactions = []
+        for filename in filenames:
+            fingerprint = get_file_fingerprint(filename)
+            cached_fingerprint, file_transactions = self.files.get(filename, (None, None))
+            if cached_fingerprint == fingerprint:
+                instrumentation.count('files_reused')
+            else:
+                instrumentation.count('files_parsed')
+                file_transactions = get_transactions([filename], corporate_actions, scaled=scaled)
+                self.files[filename] = (fingerprint, file_transactions)
+            statements_transactions.append(file_transactions)
+        for filename in set(self.files) - set(filenames):
+            del self.files[filename]
+        return list(heapq.merge(*statements_transactions, key=attrgetter('date')))
+
+    def get_processed_groups(self, groups, processes=PROCESSES, lot_matching_strategy=LOT_MATCHING_STRATEGY, verbosity=VERBOSITY, arithmetic=ARITHMETIC):
+        """Same as get_processed_groups, results of not changed groups are reused"""
+        fingerprints = [
+            get_group_fingerprint(group, opening_lots, lot_matching_strategy, verbosity, arithmetic)
+            for key, group, opening_lots in groups
+        ]
+        changed = [
+            index for index, ((key, _, _), fingerprint) in enumerate(zip(groups, fingerprints))
+            if self.groups.get(key, (None, None))[0] != fingerprint
+        ]
+        instrumentation.count('groups_reused', len(groups) - len(changed))
+        processed = get_processed_groups([groups[index] for index in changed], processes, lot_matching_strategy, verbosity, arithmetic)
+        for index, processed_group in zip(changed, processed):
+            self.groups[groups[index][0]] = (fingerprints[index], processed_group)
+        keys = [key for key, _, _ in groups]
+        for key in set(self.groups) - set(keys):
+            del self.groups[key]
+        return [self.groups[key][1] for key in keys]
+
+
 def get_transactions_dates(transactions):
     dates = set()
     for transaction in transactions:
-        dates.add(transaction.date.isoformat())
+        dates.add(transaction.date)
     return dates
 
 
-def fill_transactions_with_prices(transactions):
+def fill_transactions_with_prices(transactions, rate_tables):
+    """Dates of transactions in each currency are joined with its rate table in one step"""
+    transactions_of_currencies = OrderedDict()
+    for transaction in transactions:
+        transactions_of_currencies.setdefault(transaction.currency_code, []).append(transaction)
+    for currency, currency_transactions in transactions_of_currencies.items():
+        rate_table = rate_tables.get(currency)
+        if rate_table is None:
+            continue
+        indexes = rate_table.get_indexes_before([transaction.date.toordinal() for transaction in currency_transactions])
+        for transaction, index in zip(currency_transactions, indexes):
+            transaction.usd_price_in_given_date = rate_table.get_rate_by_index(index)
+            transaction.scaled_rate = rate_table.rates[index] if index >= 0 else None
+
+
+def skip_transaction_without_rate(transaction, rated_currencies):
+    """Raises when currency of transaction is one of rated_currencies, as skipping it would change results of its group"""
+    if transaction.currency_code in rated_currencies:
+        raise ValueError(f'no NBP table {NBP_TABLE} rate of {transaction.currency_code} before {transaction.date} for {transaction}')
+    instrumentation.count('lines_skipped')
+    logging.error(f'{transaction.currency_code} is not in NBP table {NBP_TABLE}, skipped {transaction}')
+
+
+def get_priced_transactions(transactions, rated_currencies):
+    """Transactions filled with rate. The rest is logged and skipped when its currency is not in NBP table,
+    rated_currencies (currencies listed in it) have to have rates for every transaction.
+    """
+    priced_transactions = []
     for transaction in transactions:
-        transaction.usd_price_in_given_date = prices_of_usd_in_pln_in_date.get(transaction.date.isoformat())
+        if transaction.usd_price_in_given_date:
+            priced_transactions.append(transaction)
+        else:
+            skip_transaction_without_rate(transaction, rated_currencies)
+    return priced_transactions
 
 
 def count_pln_values(transactions):
@@ -484,12 +2040,12 @@ def count_pln_values(transactions):
         transaction.count_pln_value()
 
 
-def get_other_costs():
+def get_other_costs_list(filename=OTHER_COSTS_FILENAME):
     """Costs like, broker costs"""
-    other_costs = decimal.Decimal(0)
     other_costs_list = []
-    # fill in Ordered Dict
-    with open('other_costs.csv') as file:
+    if not filename:
+        return other_costs_list
+    with open(filename) as file:
         other_costs_readed = file.readlines()
         for other_cost in other_costs_readed:
             splited = other_cost.split(' ')
@@ -499,14 +2055,18 @@ def get_other_costs():
                 'value_usd': decimal.Decimal(splited[1]),
             }
             other_costs_list.append(cost)
+    return other_costs_list
+
+
+def get_other_costs(other_costs_list, rate_table):
+    other_costs = decimal.Decimal(0)
     # count other costs
     print('\n-------------------- OTHER COSTS --------------------')
     for cost in other_costs_list:
-        # get or fetch usd price
-        usd_price = prices_of_usd_in_pln_in_date.get(cost['date'])
-        if not usd_price:
-            usd_price = get_usd_price_from_nbp_api(cost['date'])
-            usd_price = decimal.Decimal(usd_price)
+        # priced like transactions, with rate from the day before
+        usd_price = rate_table.get_rate_before(date.fromisoformat(cost['date']))
+        if usd_price is None:
+            raise ValueError(f'no NBP table {NBP_TABLE} rate of {DEFAULT_CURRENCY} before {cost["date"]} for other cost {cost["name"]}')
         print(f'{cost["date"]} : {usd_price}')
         cost_count = usd_price * cost['value_usd']
         print(f'{cost_count} = {usd_price} * {cost["value_usd"]}')
@@ -516,12 +2076,73 @@ def get_other_costs():
     return other_costs
 
 
-def show_results(result, other_costs):
-    TAX = decimal.Decimal('0.19')
-    # print('-------------------------')
-    # print(result)
+def save_checkpoint(filename, result, period_end, corporate_actions=None):
+    """Save open lots of every group, so next period can be counted without statements of this one.
+    Split multiplier of corporate_actions already applied to quantities is saved with every lot.
+    """
+    corporate_actions = corporate_actions or default_corporate_actions
+    lots = OrderedDict()
+    for res in result:
+        if not res:
+            continue
+        if res.get('stocks_left') < 0:
+            logging.error(f'[{res.get("key")}] sold more stocks than bought, it is not saved in checkpoint')
+        for lot in res.get('open_lots'):
+            transaction = lot.transaction
+            lots.setdefault(res.get('key'), []).append({
+                'entity_name': transaction.entity_name,
+                'currency_code': transaction.currency_code,
+                'date': transaction.date.isoformat(),
+                'quantity_left': str(lot.quantity),
+                'quantity_of_stocks': str(transaction.quantity_of_stocks),
+                'value_usd': str(transaction.value_usd),
+                'usd_price_in_given_date': str(transaction.usd_price_in_given_date),
+                'value_pln': str(transaction.value_pln),
+                'split_multiplier': str(corporate_actions.get_multiplier(res.get('key'), transaction.date)),
+            })
+    with open(filename, 'w') as file:
+        json.dump({
+            'version': CHECKPOINT_VERSION,
+            'period_end': period_end.isoformat() if period_end else None,
+            'lots': lots,
+        }, file, indent=1)
+
+
+def load_checkpoint(filename, corporate_actions=None):
+    """(period end date, {key: [(transaction, quantity left), ...]}) saved by save_checkpoint.
+    Quantities are adjusted by splits of corporate_actions not applied when the checkpoint was saved.
+    Lots saved without split multiplier are taken as adjusted by all of them.
+    """
+    corporate_actions = corporate_actions or default_corporate_actions
+    with open(filename) as file:
+        checkpoint = json.load(file, object_pairs_hook=OrderedDict)
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f'{filename} has unknown checkpoint version {checkpoint.get("version")}')
+    opening_lots = OrderedDict()
+    for key, lots in checkpoint['lots'].items():
+        opening_lots[key] = []
+        for lot in lots:
+            lot_date = date.fromisoformat(lot['date'])
+            multiplier = Fraction(corporate_actions.get_multiplier(key, lot_date))
+            split_multiplier = multiplier / Fraction(lot.get('split_multiplier', multiplier))
+            transaction = Transaction.from_values(
+                key,
+                lot['entity_name'],
+                'BUY',
+                lot_date,
+                decimal.Decimal(lot['value_usd']),
+                get_split_adjusted_quantity(decimal.Decimal(lot['quantity_of_stocks']), split_multiplier),
+                decimal.Decimal(lot['usd_price_in_given_date']),
+                lot.get('currency_code', DEFAULT_CURRENCY),
+            )
+            transaction.value_pln = decimal.Decimal(lot['value_pln'])
+            opening_lots[key].append((transaction, get_split_adjusted_quantity(decimal.Decimal(lot['quantity_left']), split_multiplier)))
+    period_end = checkpoint.get('period_end')
+    return date.fromisoformat(period_end) if period_end else None, opening_lots
 
-    print('\n------------PROFIT-------------')
+
+def get_totals(result, other_costs):
+    """Totals of all groups, as they are shown by show_results"""
     profit_stocks = sum([res.get('profit') for res in result if res])
     profit_stocks = round(profit_stocks, 4)
     cost_stocks = sum([res.get('cost') for res in result if res])
@@ -542,6 +2163,43 @@ def show_results(result, other_costs):
     tax_stocks_to_pay = TAX * profit_stocks
     tax_total_to_pay = TAX * (income_total - cost_total)
     tax_other_costs = TAX * other_costs
+    return OrderedDict([
+        ('profit_stocks', profit_stocks),
+        ('cost_stocks', cost_stocks),
+        ('income_stocks', income_stocks),
+        ('profit_div', profit_div),
+        ('income_div', income_div),
+        ('cost_div', cost_div),
+        ('profit_total', profit_total),
+        ('income_total', income_total),
+        ('cost_total', cost_total),
+        ('tax_div_to_pay', tax_div_to_pay),
+        ('tax_stocks_to_pay', tax_stocks_to_pay),
+        ('tax_total_to_pay', tax_total_to_pay),
+        ('tax_other_costs', tax_other_costs),
+    ])
+
+
+def show_results(result, other_costs):
+    """Prints totals and returns them as lines of report"""
+    # print('-------------------------')
+    # print(result)
+
+    print('\n------------PROFIT-------------')
+    totals = get_totals(result, other_costs)
+    profit_stocks = totals['profit_stocks']
+    cost_stocks = totals['cost_stocks']
+    income_stocks = totals['income_stocks']
+    profit_div = totals['profit_div']
+    income_div = totals['income_div']
+    cost_div = totals['cost_div']
+    profit_total = totals['profit_total']
+    income_total = totals['income_total']
+    cost_total = totals['cost_total']
+    tax_div_to_pay = totals['tax_div_to_pay']
+    tax_stocks_to_pay = totals['tax_stocks_to_pay']
+    tax_total_to_pay = totals['tax_total_to_pay']
+    tax_other_costs = totals['tax_other_costs']
 
     profit_msg = f'profit_stocks  {profit_stocks}'
     cost_msg = f'cost_stocks    {cost_stocks}'
@@ -575,73 +2233,902 @@ def show_results(result, other_costs):
         tax_stocks_to_pay_msg,
         tax_total_to_pay_msg,
     ]
-    report_operations['total'] = []
-    report_operations['total'].append('---------------TOTAL---------------')
     for msg in msgs:
         print(msg)
-        report_operations['total'].append(msg)
+    return ['---------------TOTAL---------------'] + msgs
 
 
-def print_operations(print_to_terminal=False):
-    with open('output.csv', 'w+') as file:
-        for k, v in report_operations.items():
+def print_operations(report_operations, print_to_terminal=False, filename=OUTPUT_FILENAME):
+    """report_operations: {key: audit events, 'total': lines of totals}"""
+    with open(filename, 'w+', buffering=REPORT_BUFFER_SIZE) as file:
+        for k, events in report_operations.items():
             if k == 'total':
                 continue
-            file.write('\n')
-            file.write(k)
-            file.write('\n')
-            if print_to_terminal:
-                print('')
-                print(k)
-            for v1 in v:
-                file.write(v1)
-                file.write('\n')
-                if print_to_terminal:
-                    print(v1)
-        totals = report_operations.get('total')
-        for total in totals:
+            lines = get_audit_lines(events)
+            file.write(f'\n{k}\n')
+            file.writelines(f'{line}\n' for line in lines)
             if print_to_terminal:
-                print('')
-                print(k)
-                print(total)
-            file.write(total)
-            file.write('\n')
+                print(f'\n{k}')
+                print('\n'.join(lines))
+        totals = report_operations.get('total', [])
+        file.writelines(f'{total}\n' for total in totals)
+        if print_to_terminal:
+            print('\n'.join(totals))
+
+
+def write_ledger(report_operations, filename, ledger_format=LEDGER_FORMAT):
+    """Ledger of lot matches of every group, written straight from audit events"""
+    groups_events = ((key, events) for key, events in report_operations.items() if key != 'total')
+    if ledger_format == LOTS_LEDGER_FORMAT:
+        lots_ledger = LotsLedger(filename)
+        lots_ledger.write(groups_events)
+        lots_ledger.connection.close()
+        return
+    with open(filename, 'w', newline='', buffering=REPORT_BUFFER_SIZE) as file:
+        LEDGER_WRITERS[ledger_format](file, groups_events)
+
+
+LOTS_LEDGER_OPEN = 'OPEN'
+LOTS_LEDGER_CONSUME = 'CONSUME'  # part of the lot sold
+LOTS_LEDGER_CLOSE = 'CLOSE'  # the rest of the lot sold
+
+
+def iter_lots_ledger_rows(events):
+    """(date, event, lot_index, lot_date, quantity, cost_pln) of single group, in order of date.
+    Lot is opened with the cost of all its consumptions and the cost of what is left open,
+    so cost basis of closed lots is back to exactly zero.
+    """
+    openings = OrderedDict()  # lot_index: [lot transaction, quantity, cost]
+    consumptions = []
+    for event in events:
+        if event.event_type == AUDIT_LOT:
+            opening = openings.setdefault(event.lot_index, [event.lot_transaction, event.lot_quantity, decimal.Decimal(0)])
+            opening[2] += event.cost
+            event_type = LOTS_LEDGER_CLOSE if event.lot_quantity == event.quantity else LOTS_LEDGER_CONSUME
+            consumptions.append((event.transaction.date, event_type, event.lot_index, event.lot_transaction.date, -event.quantity, -event.cost))
+        elif event.event_type == AUDIT_SUMMARY:
+            for lot in event.result['open_lots']:
+                opening = openings.setdefault(lot.index, [lot.transaction, lot.quantity, decimal.Decimal(0)])
+                opening[2] += lot.transaction.get_value_pln_for_given_amount_of_stocks(lot.quantity)
+    rows = [
+        (lot_transaction.date, LOTS_LEDGER_OPEN, lot_index, lot_transaction.date, quantity, cost)
+        for lot_index, (lot_transaction, quantity, cost) in openings.items()
+    ]
+    # stable sort, so openings are before consumptions of the same day
+    rows.extend(consumptions)
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+class LotsLedger(object):
+    """Lot openings, partial consumptions and closures of every group with position and cost basis after each of them.
+    Rows are keyed by (key, date, seq), seq orders rows of the key, so position at any date is a single index lookup.
+    Quantities and pln values are kept as decimal text.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS lots ('
+            'key TEXT, date TEXT, seq INTEGER, event TEXT, lot_index INTEGER, lot_date TEXT, quantity TEXT, cost_pln TEXT, '
+            'position TEXT, cost_basis_pln TEXT, '
+            'PRIMARY KEY (key, date, seq)) WITHOUT ROWID'
+        )
+        self.connection.commit()
+
+    def write(self, groups_events):
+        """Replaces the ledger with lots of given groups"""
+        with self.connection:
+            self.connection.execute('DELETE FROM lots')
+            for key, events in groups_events:
+                position = cost_basis = decimal.Decimal(0)
+                rows = []
+                for seq, (row_date, event_type, lot_index, lot_date, quantity, cost) in enumerate(iter_lots_ledger_rows(events)):
+                    position += quantity
+                    cost_basis += cost
+                    rows.append((
+                        key, row_date.isoformat(), seq, event_type, lot_index, lot_date.isoformat(), str(quantity), str(cost),
+                        str(position), str(cost_basis),
+                    ))
+                self.connection.executemany('INSERT INTO lots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def get_position(self, key, as_of):
+        """(quantity held, pln cost basis) of key at the end of as_of date"""
+        row = self.connection.execute(
+            'SELECT position, cost_basis_pln FROM lots WHERE key = ? AND date <= ? ORDER BY date DESC, seq DESC LIMIT 1',
+            (key, as_of.isoformat()),
+        ).fetchone()
+        if row is None:
+            return decimal.Decimal(0), decimal.Decimal(0)
+        return decimal.Decimal(row[0]), decimal.Decimal(row[1])
+
+    def get_open_lots(self, key, as_of):
+        """[(lot date, quantity, pln cost), ...] of lots of key open at the end of as_of date"""
+        lots = OrderedDict()
+        rows = self.connection.execute(
+            'SELECT lot_index, lot_date, quantity, cost_pln FROM lots WHERE key = ? AND date <= ? ORDER BY date, seq',
+            (key, as_of.isoformat()),
+        )
+        for lot_index, lot_date, quantity, cost in rows:
+            lot = lots.setdefault(lot_index, [date.fromisoformat(lot_date), decimal.Decimal(0), decimal.Decimal(0)])
+            lot[1] += decimal.Decimal(quantity)
+            lot[2] += decimal.Decimal(cost)
+        return [tuple(lot) for lot in lots.values() if lot[1] != 0]
+
+    def get_holdings(self, as_of):
+        """{key: (quantity held, pln cost basis)} of every key with not zero position at the end of as_of date"""
+        holdings = OrderedDict()
+        for (key,) in self.connection.execute('SELECT DISTINCT key FROM lots ORDER BY key').fetchall():
+            position, cost_basis = self.get_position(key, as_of)
+            if position != 0:
+                holdings[key] = (position, cost_basis)
+        return holdings
+
+
+def show_holdings(ledger_filename, as_of):
+    lots_ledger = LotsLedger(ledger_filename)
+    print(f'holdings at the end of {as_of.isoformat()}:')
+    for key, (position, cost_basis) in lots_ledger.get_holdings(as_of).items():
+        print(f'{key}: quantity: {position}, cost basis: {round(cost_basis, 2)} PLN')
+    lots_ledger.connection.close()
+
+
+class OpenLotsIndex(object):
+    """Open lots of single group in order they are sold, with prefix sums of their quantity and pln cost,
+    so cost of selling any quantity is found with bisect instead of matching lots again.
+    """
+
+    def __init__(self, key, open_lots):
+        self.key = key
+        self.lots = [lot for lot in open_lots if lot.quantity > 0]
+        self.currency_code = self.lots[0].transaction.currency_code if self.lots else DEFAULT_CURRENCY
+        self.quantities = [decimal.Decimal(0)]
+        self.costs = [decimal.Decimal(0)]
+        for lot in self.lots:
+            self.quantities.append(self.quantities[-1] + lot.quantity)
+            self.costs.append(self.costs[-1] + lot.transaction.get_value_pln_for_given_amount_of_stocks(lot.quantity))
+
+    def get_quantity(self):
+        return self.quantities[-1]
+
+    def get_cost(self, quantity):
+        """Pln cost of quantity sold from open lots, same as when sell is matched. None when there is not enough stocks"""
+        if quantity <= 0:
+            raise ValueError(f'[{self.key}] quantity {quantity} is not positive')
+        if quantity > self.quantities[-1]:
+            return None
+        index = bisect_left(self.quantities, quantity)
+        if self.quantities[index] == quantity:
+            return self.costs[index]
+        lot = self.lots[index - 1]
+        return self.costs[index - 1] + lot.transaction.get_value_pln_for_given_amount_of_stocks(quantity - self.quantities[index - 1])
+
+
+def get_open_lots_indexes(result):
+    """{key: OpenLotsIndex} of every group with open lots"""
+    indexes = OrderedDict()
+    for res in result:
+        if res and res.get('open_lots'):
+            indexes[res['key']] = OpenLotsIndex(res['key'], res['open_lots'])
+    return indexes
+
+
+SellScenario = namedtuple('SellScenario', ['key', 'quantity', 'price', 'income', 'cost', 'profit', 'tax', 'tax_saved'])
+SELL_SCENARIO_RANKS = {
+    'tax_saved': lambda scenario: (-scenario.tax_saved, -scenario.profit),  # the same saving with smaller loss first
+    'loss': lambda scenario: scenario.profit,
+}
+
+
+def get_sell_scenarios(indexes, candidates, rates, totals, rank=WHAT_IF_RANK):
+    """Hypothetical sells evaluated together against open lots, ranked by rank.
+    candidates: [(key, quantity, price in currency of the group), ...]
+    rates: {currency: rate in pln used for sell}, sells in currency without rate are logged and skipped
+    totals: get_totals of counted period, tax of every sell is counted as the only additional one
+    """
+    profit_total = totals['income_total'] - totals['cost_total']
+    tax = max(TAX * profit_total, 0)
+    scenarios = []
+    for key, quantity, price in candidates:
+        index = indexes.get(key)
+        cost = index.get_cost(quantity) if index is not None else None
+        if cost is None:
+            logging.error(f'[{key}] can not sell {quantity}, there are only {index.get_quantity() if index else 0} stocks left')
+            continue
+        rate = rates.get(index.currency_code)
+        if rate is None:
+            logging.error(f'[{key}] no NBP table {NBP_TABLE} rate of {index.currency_code}, sell of {quantity} at {price} is skipped')
+            continue
+        income = abs(quantity * price * rate)
+        profit = income - cost
+        scenario_tax = max(TAX * (profit_total + profit), 0)
+        scenarios.append(SellScenario(key, quantity, price, income, cost, profit, scenario_tax, tax - scenario_tax))
+    scenarios.sort(key=SELL_SCENARIO_RANKS[rank])
+    return scenarios
+
+
+def get_sell_candidates(filename, indexes):
+    """
+    Example lines:
+    TSLA 10 420.5
+    AAPL all 120,125,130
+    MSFT 25%,50%,all 300
+    quantities and prices separated with comma are combined with each other, % is part of stocks left.
+    all and % of group without stocks left are logged and skipped, like sells of more stocks than left.
+    """
+    candidates = []
+    for line_number, line in iter_statement_lines(filename):
+        if line.startswith('#'):
+            continue
+        try:
+            key, quantities, prices = line.split()
+            index = indexes.get(key)
+            held = index.get_quantity() if index is not None else decimal.Decimal(0)
+            for quantity in quantities.split(','):
+                if (quantity == 'all' or quantity.endswith('%')) and held == 0:
+                    logging.error(f'{filename}:{line_number}: [{key}] there are no stocks left, {quantity} is skipped')
+                    continue
+                if quantity == 'all':
+                    quantity = held
+                elif quantity.endswith('%'):
+                    quantity = held * decimal.Decimal(quantity[:-1]) / 100
+                else:
+                    quantity = decimal.Decimal(quantity)
+                if quantity <= 0:
+                    raise ValueError(f'quantity {quantity} is not positive')
+                for price in prices.split(','):
+                    candidates.append((key, quantity, decimal.Decimal(price)))
+        except (ValueError, decimal.InvalidOperation) as error:
+            raise ValueError(f'{filename}:{line_number}: wrong sell scenario {line}: {error}')
+    return candidates
+
+
+def run_what_if(result, other_costs, filename, sell_date=None, rank=WHAT_IF_RANK, top=WHAT_IF_TOP):
+    """Prints the best of hypothetical sells from filename, made on sell_date (today by default)"""
+    sell_date = sell_date or date.today()
+    indexes = get_open_lots_indexes(result)
+    candidates = get_sell_candidates(filename, indexes)
+    currencies = {index.currency_code for index in indexes.values()}
+    unlisted_currencies = prefetch_rates([sell_date], [], currencies)
+    rates = {
+        currency: rate_table.get_rate_before(sell_date)
+        for currency, rate_table in get_rate_tables(currencies, unlisted_currencies).items()
+    }
+    scenarios = get_sell_scenarios(indexes, candidates, rates, get_totals(result, other_costs), rank)
+    print(f'\n------------WHAT IF SOLD ON {sell_date.isoformat()}: {len(scenarios)} scenarios, best by {rank}-------------')
+    for scenario in scenarios[:top]:
+        print(
+            f'[{scenario.key}] sell {scenario.quantity} at {scenario.price}: income {round(scenario.income, 4)} '
+            f'- cost {round(scenario.cost, 4)} = {round(scenario.profit, 4)}, tax {round(scenario.tax, 4)}, '
+            f'tax saved {round(scenario.tax_saved, 4)}'
+        )
+    return scenarios
+
+
+def read_statements(
+    filenames,
+    columnar=COLUMNAR_STORE,
+    corporate_actions=None,
+    incremental_cache=None,
+    parse_processes=1,
+    parse_cache=None,
+    scaled=False,
+):
+    """(transactions, their dates, their currencies with DEFAULT_CURRENCY).
+    With parse_cache in columnar store, cached statements which do not overlap are joined without creating transactions.
+    With scaled, values are kept as scaled integers for fixed point arithmetic, columnar store and parse cache always keep them.
+    """
+    if incremental_cache is not None:
+        transactions = incremental_cache.get_transactions(filenames, corporate_actions, scaled)
+    elif columnar and parse_cache is not None:
+        statements_columns = [parse_cache.get_columns(filename, corporate_actions, parse_processes) for filename in filenames]
+        transactions = get_concatenated_columns(statements_columns)
+        if transactions is None:
+            transactions = TransactionColumns.from_transactions(heapq.merge(*statements_columns, key=attrgetter('date')))
+    elif columnar:
+        transactions = TransactionColumns.from_transactions(
+            iter_merged_transactions(filenames, corporate_actions, parse_processes, scaled=True),
+        )
+    else:
+        transactions = get_transactions(filenames, corporate_actions, parse_processes, parse_cache, scaled)
+    if isinstance(transactions, TransactionColumns):
+        dates = transactions.get_dates()
+        currencies = set(transactions.currencies)
+    else:
+        dates = get_transactions_dates(transactions)
+        currencies = get_transactions_currencies(transactions)
+    currencies.add(DEFAULT_CURRENCY)
+    return transactions, dates, currencies
+
+
+def get_opening_lots(load_checkpoint_filename, dates, corporate_actions=None):
+    if not load_checkpoint_filename:
+        return None
+    checkpoint_period_end, opening_lots = load_checkpoint(load_checkpoint_filename, corporate_actions)
+    if checkpoint_period_end and dates and min(dates) <= checkpoint_period_end:
+        logging.error(f'transactions from {min(dates)} are older than checkpoint end {checkpoint_period_end}')
+    return opening_lots
+
+
+def get_verbosity_with_ledger(verbosity, ledger_filename):
+    """Ledger is written from audit events, so they are recorded whenever it is asked for"""
+    if ledger_filename and verbosity < VERBOSITY_REPORT:
+        logging.error(f'verbosity {verbosity} records no audit events, {VERBOSITY_REPORT} is used for ledger {ledger_filename}')
+        return VERBOSITY_REPORT
+    return verbosity
+
+
+def count_taxes(
+    transactions,
+    dates,
+    other_costs_list,
+    rate_tables,
+    output_filename=OUTPUT_FILENAME,
+    processes=PROCESSES,
+    arithmetic=ARITHMETIC,
+    verbosity=VERBOSITY,
+    lot_matching_strategy=LOT_MATCHING_STRATEGY,
+    opening_lots=None,
+    save_checkpoint_filename=SAVE_CHECKPOINT,
+    ledger_filename=LEDGER_FILENAME,
+    ledger_format=LEDGER_FORMAT,
+    incremental_cache=None,
+    corporate_actions=None,
+):
+    """Taxes from read statements, with rates already in rate_tables. Returns results of every group and other costs."""
+    report_operations = OrderedDict()
+    verbosity = get_verbosity_with_ledger(verbosity, ledger_filename)
+    with instrumentation.stage('fill_transactions_with_prices'):
+        if isinstance(transactions, TransactionColumns):
+            transactions.fill_rates(rate_tables)
+        else:
+            fill_transactions_with_prices(transactions, rate_tables)
+            transactions = get_priced_transactions(transactions, rate_tables)
+    with instrumentation.stage('count_pln_values'):
+        if isinstance(transactions, TransactionColumns):
+            grouped_transactions = transactions.get_grouped_transactions(rate_tables)
+        else:
+            count_pln_values(transactions)
+            grouped_transactions = get_grouped_transactions(transactions)
+    with instrumentation.stage('get_processed_transactions_result'):
+        result = get_processed_transactions_result(
+            grouped_transactions, processes, lot_matching_strategy, verbosity, arithmetic, opening_lots, incremental_cache,
+            report_operations,
+        )
+    other_costs = report_taxes(
+        result, report_operations, dates, other_costs_list, rate_tables[DEFAULT_CURRENCY], output_filename,
+        save_checkpoint_filename, ledger_filename, ledger_format, corporate_actions,
+    )
+    return result, other_costs
+
+
+def report_taxes(
+    result,
+    report_operations,
+    dates,
+    other_costs_list,
+    rate_table,
+    output_filename=OUTPUT_FILENAME,
+    save_checkpoint_filename=SAVE_CHECKPOINT,
+    ledger_filename=LEDGER_FILENAME,
+    ledger_format=LEDGER_FORMAT,
+    corporate_actions=None,
+):
+    """Counts other costs with rate_table of DEFAULT_CURRENCY, saves checkpoint, shows and writes reports"""
+    with instrumentation.stage('get_other_costs'):
+        other_costs = get_other_costs(other_costs_list, rate_table)
+    if save_checkpoint_filename:
+        save_checkpoint(save_checkpoint_filename, result, max(dates) if dates else None, corporate_actions)
+    with instrumentation.stage('show_results'):
+        report_operations['total'] = show_results(result, other_costs)
+    with instrumentation.stage('print_operations'):
+        print_operations(report_operations, filename=output_filename)
+        if ledger_filename:
+            write_ledger(report_operations, ledger_filename, ledger_format)
+    return other_costs
 
 
-def run():
+class PipelineRatesFetcher(object):
+    """Fetches NBP tables in background threads as soon as dates of transactions are known.
+    Ranges already cached or already requested are not fetched again.
+    Fetched rates are put into rates cache from event loop thread, as sqlite connection is not shared.
+    """
+
+    def __init__(self, loop, executor):
+        self.loop = loop
+        self.executor = executor
+        self.cache = get_rates_cache()
+        self.requested_ranges = []
+        self.tasks = []  # [((start, end), task), ...]
+        self.rates = {}  # (currency, date): rate from the last business day before date
+
+    def request(self, requested_dates, currencies):
+        currencies = [currency for currency in currencies if currency != LOCAL_CURRENCY]
+        for start_date, end_date in get_date_ranges_to_fetch(requested_dates):
+            for currency in currencies:
+                for missing_start, missing_end in self.cache.get_missing_ranges(NBP_TABLE, currency.lower(), start_date, end_date):
+                    for missing_range in get_uncovered_ranges(sorted(self.requested_ranges), missing_start, missing_end):
+                        self.requested_ranges.append(missing_range)
+                        self.tasks.append((missing_range, self.loop.create_task(self.fetch(*missing_range))))
+
+    async def fetch(self, start_date, end_date):
+        get_nbp_session()  # created by the first fetch in event loop thread, before fetching threads share it
+        currencies_rates = await self.loop.run_in_executor(self.executor, get_tables_from_nbp_api, start_date, end_date)
+        if currencies_rates is None:
+            raise ConnectionError(f'NBP table {NBP_TABLE} is not fetched for {get_ranges_description([(start_date, end_date)])}')
+        self.cache.add_rates(NBP_TABLE, start_date, end_date, currencies_rates)
+
+    async def wait(self, start_date, end_date):
+        """Until every requested range overlapping <start_date, end_date> is fetched"""
+        import asyncio
+        await asyncio.gather(*[
+            task for (range_start, range_end), task in self.tasks if range_start <= end_date and range_end >= start_date
+        ])
+
+    def get_rate_before(self, currency, transaction_date):
+        """None when there is no rate, also when currency is not in NBP table"""
+        if currency == LOCAL_CURRENCY:
+            return decimal.Decimal(1)
+        if (currency, transaction_date) not in self.rates:
+            rate_date = transaction_date - timedelta(days=1)
+            rate = self.cache.get_rate(NBP_TABLE, currency.lower(), rate_date)
+            if rate is None and not get_unlisted_currencies([currency]):
+                # no table in holiday margin, walked back synchronously
+                rate = get_price_from_nbp_api(rate_date.isoformat(), currency)
+            self.rates[(currency, transaction_date)] = rate
+        return self.rates[(currency, transaction_date)]
+
+
+async def get_processed_group_when_rates_fetched(fetcher, executor, process_group, key, group, opening_lots):
+    """Values group as soon as all its rates are fetched and processes it in executor, or in event loop without one"""
+    import asyncio
+    if group:
+        first_date = min(transaction.date for transaction in group)
+        last_date = max(transaction.date for transaction in group)
+        await fetcher.wait(first_date - timedelta(days=NBP_HOLIDAY_MARGIN_DAYS + 1), last_date - timedelta(days=1))
+        for transaction in group:
+            transaction.usd_price_in_given_date = fetcher.get_rate_before(transaction.currency_code, transaction.date)
+            transaction.scaled_rate = None
+        currencies = {transaction.currency_code for transaction in group}
+        group = get_priced_transactions(group, currencies.difference(get_unlisted_currencies(currencies)))
+        for transaction in group:
+            transaction.count_pln_value()
+    if executor is None:
+        return process_group(key, group, opening_lots=opening_lots)
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(process_group, key, group, opening_lots=opening_lots))
+
+
+async def get_pipelined_result(
+    filenames,
+    corporate_actions=None,
+    other_costs_list=(),
+    processes=PROCESSES,
+    lot_matching_strategy=LOT_MATCHING_STRATEGY,
+    verbosity=VERBOSITY,
+    arithmetic=ARITHMETIC,
+    load_checkpoint_filename=LOAD_CHECKPOINT,
+    report_operations=None,
+    parse_cache=None,
+):
+    """(results of every group, dates of transactions) counted in pipeline.
+    Rates of parsed transactions are requested right away, while parsing goes on,
+    every group is valued and processed as soon as rates of its dates are fetched.
+    Groups can be processed only after all statements are parsed, as any statement can add to them.
+    """
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    fetch_executor = ThreadPoolExecutor(max_workers=NBP_MAX_CONCURRENT_REQUESTS)
+    process_executor = ProcessPoolExecutor(max_workers=processes or None) if processes != 1 else None
+    fetcher = PipelineRatesFetcher(loop, fetch_executor)
+    try:
+        fetcher.request({date.fromisoformat(cost['date']) - timedelta(days=1) for cost in other_costs_list}, [DEFAULT_CURRENCY])
+        grouped_transactions = OrderedDict()
+        dates = set()
+        chunk_dates = set()
+        chunk_currencies = set()
+        transactions = iter_merged_transactions(
+            filenames, corporate_actions, processes, parse_cache, arithmetic in SCALED_ARITHMETICS,
+        )
+        for count, transaction in enumerate(transactions, 1):
+            grouped_transactions.setdefault(transaction.entity_code, []).append(transaction)
+            if transaction.date not in dates:
+                dates.add(transaction.date)
+                chunk_dates.add(transaction.date - timedelta(days=1))
+            chunk_currencies.add(transaction.currency_code)
+            if count % PIPELINE_CHUNK_TRANSACTIONS == 0:
+                fetcher.request(chunk_dates, chunk_currencies)
+                chunk_dates = set()
+                chunk_currencies = set()
+                await asyncio.sleep(0)  # fetched rates are put into cache
+        fetcher.request(chunk_dates, chunk_currencies)
+        opening_lots = get_opening_lots(load_checkpoint_filename, dates, corporate_actions) or {}
+        keys = list(opening_lots) + [key for key in grouped_transactions if key not in opening_lots]
+        process_group = partial(GROUP_PROCESSORS[arithmetic], lot_matching_strategy=lot_matching_strategy, verbosity=verbosity)
+        processed = await asyncio.gather(*[
+            get_processed_group_when_rates_fetched(
+                fetcher, process_executor, process_group, key, grouped_transactions.get(key, []), opening_lots.get(key, []),
+            )
+            for key in keys
+        ])
+        await fetcher.wait(date.min, date.max)
+    finally:
+        fetch_executor.shutdown()
+        if process_executor is not None:
+            process_executor.shutdown()
+    instrumentation.count('groups_matched', len(keys))
+    count_lots_matched(processed)
+    return get_merged_processed_groups(keys, processed, verbosity, report_operations), dates
+
+
+def run_pipelined(
+    filenames=None,
+    output_filename=OUTPUT_FILENAME,
+    other_costs_filename=OTHER_COSTS_FILENAME,
+    processes=PROCESSES,
+    arithmetic=ARITHMETIC,
+    verbosity=VERBOSITY,
+    lot_matching_strategy=LOT_MATCHING_STRATEGY,
+    load_checkpoint_filename=LOAD_CHECKPOINT,
+    save_checkpoint_filename=SAVE_CHECKPOINT,
+    ledger_filename=LEDGER_FILENAME,
+    ledger_format=LEDGER_FORMAT,
+    corporate_actions=None,
+    parse_cache=None,
+):
+    """Same as count_taxes after read_statements, but parsing, fetching rates and processing groups overlap"""
+    import asyncio
+    report_operations = OrderedDict()
+    verbosity = get_verbosity_with_ledger(verbosity, ledger_filename)
+    other_costs_list = get_other_costs_list(other_costs_filename)
+    with instrumentation.stage('pipeline'):
+        result, dates = asyncio.run(get_pipelined_result(
+            filenames, corporate_actions, other_costs_list, processes, lot_matching_strategy, verbosity, arithmetic,
+            load_checkpoint_filename, report_operations, parse_cache,
+        ))
+    # rates of other costs are already fetched, only walk back over holidays may be needed
+    prefetch_rates([], [date.fromisoformat(cost['date']) for cost in other_costs_list])
+    other_costs = report_taxes(
+        result, report_operations, dates, other_costs_list, get_rate_table(DEFAULT_CURRENCY), output_filename,
+        save_checkpoint_filename, ledger_filename, ledger_format, corporate_actions,
+    )
+    return result, other_costs
+
+
+def run(
+    filenames=None,
+    output_filename=OUTPUT_FILENAME,
+    other_costs_filename=OTHER_COSTS_FILENAME,
+    rates_cache_filename=RATES_CACHE_FILENAME,
+    columnar=COLUMNAR_STORE,
+    processes=PROCESSES,
+    arithmetic=ARITHMETIC,
+    verbosity=VERBOSITY,
+    lot_matching_strategy=LOT_MATCHING_STRATEGY,
+    load_checkpoint_filename=LOAD_CHECKPOINT,
+    save_checkpoint_filename=SAVE_CHECKPOINT,
+    instrumentation_filename=INSTRUMENTATION_FILENAME,
+    ledger_filename=LEDGER_FILENAME,
+    ledger_format=LEDGER_FORMAT,
+    corporate_actions_filename=CORPORATE_ACTIONS_FILENAME,
+    incremental_cache=None,
+    pipelined=False,
+    parse_cache_directory=PARSE_CACHE_DIRECTORY,
+    rate_tables_directory=RATE_TABLES_DIRECTORY,
+):
     """
     1. read csv
     2. count tax earn/loss
     3. return csv
+    Returns results of every group and other costs.
+    With incremental_cache only statements and groups changed since previous run are processed again,
+    parsed statements are kept as transactions then, not in columnar store.
+    When pipelined, rates are fetched while statements are parsed and groups are processed, see run_pipelined,
+    every statement and group is processed again then, so it can not be combined with incremental_cache.
+    With parse_cache_directory, statements parsed in any previous run are read from ParseCache in it.
+    With rate_tables_directory, rate tables are memory-mapped from files there, see get_rate_table.
+    """
+    if pipelined and incremental_cache is not None:
+        raise ValueError('pipelined run does not use incremental cache')
+    instrumentation.reset()
+    open_rates_cache(rates_cache_filename, rate_tables_directory)
+    if not filenames:
+        filenames = STATEMENT_FILENAMES
+
+    corporate_actions = CorporateActions.load(corporate_actions_filename) if corporate_actions_filename else None
+    parse_cache = ParseCache(parse_cache_directory) if parse_cache_directory else None
+    if pipelined:
+        result, other_costs = run_pipelined(
+            filenames, output_filename, other_costs_filename, processes, arithmetic, verbosity, lot_matching_strategy,
+            load_checkpoint_filename, save_checkpoint_filename, ledger_filename, ledger_format, corporate_actions, parse_cache,
+        )
+        if instrumentation_filename:
+            instrumentation.save(instrumentation_filename)
+        return result, other_costs
+    with instrumentation.stage('get_transactions'):
+        transactions, dates, currencies = read_statements(
+            filenames, columnar, corporate_actions, incremental_cache, processes, parse_cache, arithmetic in SCALED_ARITHMETICS,
+        )
+        other_costs_list = get_other_costs_list(other_costs_filename)
+    opening_lots = get_opening_lots(load_checkpoint_filename, dates, corporate_actions)
+    # get values of currencies in pln in date
+    with instrumentation.stage('prefetch_rates'):
+        unlisted_currencies = prefetch_rates(dates, [date.fromisoformat(cost['date']) for cost in other_costs_list], currencies)
+        rate_tables = get_rate_tables(currencies, unlisted_currencies)
+    result, other_costs = count_taxes(
+        transactions, dates, other_costs_list, rate_tables, output_filename, processes, arithmetic, verbosity,
+        lot_matching_strategy, opening_lots, save_checkpoint_filename, ledger_filename, ledger_format, incremental_cache,
+        corporate_actions,
+    )
+    if instrumentation_filename:
+        instrumentation.save(instrumentation_filename)
+    return result, other_costs
+
+
+def get_batch_clients(filename):
+    """
+    Example batch file:
+    [
+        {
+            "name": "kowalski",
+            "statements": ["kowalski/2019.csv", "kowalski/1.2020.csv"],
+            "other_costs": "kowalski/other_costs.csv",
+            "output": "kowalski/output.csv",
+            "ledger": "kowalski/ledger.csv",
+            "load_checkpoint": "kowalski/2019.checkpoint.json",
+            "save_checkpoint": "kowalski/2020.checkpoint.json"
+        },
+        ...
+    ]
+    only name and statements are required, paths are relative to directory of batch file
+    """
+    with open(filename) as file:
+        clients = json.load(file)
+    directory = os.path.dirname(os.path.abspath(filename))
+    names = set()
+    for client in clients:
+        if client['name'] in names:
+            raise ValueError(f'{filename}: client {client["name"]} is given twice')
+        names.add(client['name'])
+        client.setdefault('output', BATCH_OUTPUT_FILENAME.format(name=client['name']))
+        client['statements'] = [os.path.join(directory, statement) for statement in client['statements']]
+        for path_key in ('other_costs', 'output', 'ledger', 'load_checkpoint', 'save_checkpoint'):
+            if client.get(path_key):
+                client[path_key] = os.path.join(directory, client[path_key])
+    return clients
+
+
+def get_client_rates_needs(client, corporate_actions=None):
+    """(TransactionColumns, dates of transactions, dates of other costs, currencies) of client.
+    Statements are parsed only here, columns are kept for run_client, they are cheap to send between processes.
     """
-    print(decimal.getcontext())
-    # filename = '01.2020.csv'
-    filenames = ['2019.csv']
-    for i in range(1, 13):
-        path = f'{i}.2020.csv'
-        filenames.append(path)
-
-    transactions = get_transactions(filenames)
-    # get values of usd in pln in date
-    dates = get_transactions_dates(transactions)
-    fill_prices_of_usd_in_pln_in_date(dates)
-    print(decimal.getcontext())
-    decimal_prices()
-    fill_transactions_with_prices(transactions)
-
-    count_pln_values(transactions)
-    grouped_transactions = get_grouped_transactions(transactions)
-    # print(grouped_transactions)
-    result = get_processed_transactions_result(grouped_transactions)
-    other_costs = get_other_costs()
-    show_results(result, other_costs)
-    print_operations()
-
-
-run()
-# for i in range(1, 13):
-#     print('path')
-#     path = f'{i}.2020.csv'
-#     with open(path, 'w+') as f:
-#         print(path)
-#         print(f)
+    transactions, dates, currencies = read_statements(client['statements'], True, corporate_actions)
+    other_costs_dates = {date.fromisoformat(cost['date']) for cost in get_other_costs_list(client.get('other_costs'))}
+    return transactions, dates, other_costs_dates, currencies
+
+
+def run_client(
+    client,
+    transactions,
+    rate_tables,
+    columnar=COLUMNAR_STORE,
+    arithmetic=ARITHMETIC,
+    verbosity=VERBOSITY,
+    lot_matching_strategy=LOT_MATCHING_STRATEGY,
+    corporate_actions=None,
+):
+    """Taxes of single client of batch from its TransactionColumns, rates are taken only from rate_tables shared by all clients"""
+    dates = transactions.get_dates()
+    if not columnar:
+        transactions = list(transactions)
+    print(f'\n==================== {client["name"]} ====================')
+    return count_taxes(
+        transactions, dates, get_other_costs_list(client.get('other_costs')), rate_tables, client['output'], 1,
+        arithmetic, verbosity, lot_matching_strategy, get_opening_lots(client.get('load_checkpoint'), dates, corporate_actions),
+        client.get('save_checkpoint'), client.get('ledger'), LEDGER_FORMAT, corporate_actions=corporate_actions,
+    )
+
+
+def get_counted(function, *args, **kwargs):
+    """(value of function, counters it incremented), for function run in worker process, whose counters are lost with it"""
+    counters_before = OrderedDict(instrumentation.counters)
+    value = function(*args, **kwargs)
+    return value, OrderedDict(
+        (counter, count - counters_before.get(counter, 0)) for counter, count in instrumentation.counters.items()
+    )
+
+
+def map_counted(executor, function, *iterables):
+    """Same as executor.map, but counters of worker processes are added to instrumentation. Plain map without executor."""
+    if executor is None:
+        return list(map(function, *iterables))
+    values = []
+    for value, counters in executor.map(partial(get_counted, function), *iterables):
+        instrumentation.add_counters(counters)
+        values.append(value)
+    return values
+
+
+def run_batch(
+    batch_filename,
+    rates_cache_filename=RATES_CACHE_FILENAME,
+    processes=PROCESSES,
+    columnar=COLUMNAR_STORE,
+    arithmetic=ARITHMETIC,
+    verbosity=VERBOSITY,
+    lot_matching_strategy=LOT_MATCHING_STRATEGY,
+    corporate_actions_filename=CORPORATE_ACTIONS_FILENAME,
+    instrumentation_filename=INSTRUMENTATION_FILENAME,
+    rate_tables_directory=RATE_TABLES_DIRECTORY,
+):
+    """Taxes of many clients, every client has own statements and reports.
+    Rates needed by all clients are fetched at once and one set of rate tables is shared by them,
+    clients are processed by pool of worker processes.
+    Returns {client name: (results of every group, other costs)}.
+    """
+    instrumentation.reset()
+    open_rates_cache(rates_cache_filename, rate_tables_directory)
+    clients = get_batch_clients(batch_filename)
+    corporate_actions = CorporateActions.load(corporate_actions_filename) if corporate_actions_filename else None
+    executor = None
+    if processes != 1 and len(clients) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=processes or None)
+    try:
+        with instrumentation.stage('prefetch_rates'):
+            clients_transactions = []
+            dates = set()
+            other_costs_dates = set()
+            currencies = set()
+            for client_transactions, client_dates, client_other_costs_dates, client_currencies in map_counted(
+                executor, partial(get_client_rates_needs, corporate_actions=corporate_actions), clients,
+            ):
+                clients_transactions.append(client_transactions)
+                dates.update(client_dates)
+                other_costs_dates.update(client_other_costs_dates)
+                currencies.update(client_currencies)
+            unlisted_currencies = prefetch_rates(dates, other_costs_dates, currencies)
+            rate_tables = get_rate_tables(currencies, unlisted_currencies)
+        with instrumentation.stage('run_clients'):
+            results = OrderedDict(zip(
+                [client['name'] for client in clients],
+                map_counted(
+                    executor,
+                    partial(
+                        run_client, rate_tables=rate_tables, columnar=columnar, arithmetic=arithmetic, verbosity=verbosity,
+                        lot_matching_strategy=lot_matching_strategy, corporate_actions=corporate_actions,
+                    ),
+                    clients,
+                    clients_transactions,
+                ),
+            ))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if instrumentation_filename:
+        instrumentation.save(instrumentation_filename)
+    return results
+
+
+def get_files_signatures(filenames):
+    """(size, modification time) of every file, None for missing ones"""
+    signatures = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            signatures.append(None)
+            continue
+        signatures.append((stat.st_size, stat.st_mtime_ns))
+    return signatures
+
+
+def watch(filenames=None, interval=WATCH_INTERVAL_SECONDS, **run_arguments):
+    """Run again whenever any statement, other costs or corporate actions file changes.
+    Statements which do not exist yet are skipped until they appear.
+    Only changed statements are parsed and only groups with changed transactions are processed.
+    A failed run is logged and watching goes on.
+    """
+    filenames = filenames or STATEMENT_FILENAMES
+    watched_filenames = list(filenames) + [
+        filename for filename in (
+            run_arguments.get('other_costs_filename', OTHER_COSTS_FILENAME),
+            run_arguments.get('corporate_actions_filename', CORPORATE_ACTIONS_FILENAME),
+        ) if filename
+    ]
+    incremental_cache = IncrementalCache()
+    signatures = None
+    while True:
+        current_signatures = get_files_signatures(watched_filenames)
+        if current_signatures != signatures:
+            signatures = current_signatures
+            existing_filenames = [filename for filename, signature in zip(filenames, signatures) if signature is not None]
+            print(f'\n==================== {time.strftime("%Y-%m-%d %H:%M:%S")} {len(existing_filenames)} statements ====================')
+            if existing_filenames:
+                try:
+                    run(existing_filenames, incremental_cache=incremental_cache, **run_arguments)
+                except Exception:
+                    logging.exception('run failed, waiting for next change')
+        time.sleep(interval)
+
+
+def get_arguments_parser():
+    parser = argparse.ArgumentParser(description='Count polish tax from stocks and dividends in broker statements.')
+    parser.add_argument('statements', nargs='*', help=f'statement files in chronological order (default: {" ".join(STATEMENT_FILENAMES)})')
+    parser.add_argument('-o', '--output', default=OUTPUT_FILENAME, help='report of every group')
+    parser.add_argument('--other-costs', default=OTHER_COSTS_FILENAME, help='broker costs file, empty for none')
+    parser.add_argument('--rates-cache', default=RATES_CACHE_FILENAME, help='sqlite file with NBP rates')
+    parser.add_argument('--rate-tables', default=RATE_TABLES_DIRECTORY, help='directory where rate tables are kept memory-mapped')
+    parser.add_argument('--columnar', action='store_true', default=COLUMNAR_STORE, help='compact store for big statements')
+    parser.add_argument('--processes', type=int, default=PROCESSES, help='worker processes matching groups, 0 for one per cpu')
+    parser.add_argument('--arithmetic', choices=['decimal', 'fixed_point', 'fixed_point_checked'], default=ARITHMETIC)
+    parser.add_argument('--lot-matching', choices=list(LOT_MATCHERS), default=LOT_MATCHING_STRATEGY)
+    parser.add_argument('--verbosity', type=int, choices=[VERBOSITY_NONE, VERBOSITY_REPORT, VERBOSITY_LOGS], default=VERBOSITY)
+    parser.add_argument('--load-checkpoint', default=LOAD_CHECKPOINT, help='open lots saved at the end of previous period')
+    parser.add_argument('--save-checkpoint', default=SAVE_CHECKPOINT, help='save open lots at the end of this period')
+    parser.add_argument('--ledger', default=LEDGER_FILENAME, help='ledger with one row per lot match')
+    parser.add_argument('--ledger-format', choices=list(LEDGER_WRITERS) + [LOTS_LEDGER_FORMAT], default=LEDGER_FORMAT)
+    parser.add_argument('--holdings', type=date.fromisoformat, help=f'show holdings at date from {LOTS_LEDGER_FORMAT} ledger, without run')
+    parser.add_argument('--corporate-actions', default=CORPORATE_ACTIONS_FILENAME, help='stock splits used instead of built-in ones')
+    parser.add_argument('--parse-cache', default=PARSE_CACHE_DIRECTORY, help='directory where parsed statements are kept for next runs')
+    parser.add_argument('--pipelined', action='store_true', help='fetch rates while statements are parsed and groups processed')
+    parser.add_argument('--watch', action='store_true', help='run again when statements change, only changes are processed')
+    parser.add_argument('--watch-interval', type=float, default=WATCH_INTERVAL_SECONDS, help='seconds between checks for changes')
+    parser.add_argument('--what-if', default=WHAT_IF_FILENAME, help='hypothetical sells of open lots, see get_sell_candidates')
+    parser.add_argument('--what-if-date', type=date.fromisoformat, help='date of hypothetical sells, today by default')
+    parser.add_argument('--what-if-rank', choices=list(SELL_SCENARIO_RANKS), default=WHAT_IF_RANK)
+    parser.add_argument('--batch', help='json file with statements of many clients, see get_batch_clients')
+    parser.add_argument('--stats', default=INSTRUMENTATION_FILENAME, help='save timings and counters as json')
+    return parser
+
+
+def main(argv=None):
+    args = get_arguments_parser().parse_args(argv)
+    if args.holdings:
+        if not args.ledger:
+            logging.error(f'--holdings needs --ledger written with --ledger-format {LOTS_LEDGER_FORMAT}')
+            return
+        show_holdings(args.ledger, args.holdings)
+        return
+    if args.batch:
+        run_batch(
+            args.batch, args.rates_cache, args.processes, args.columnar, args.arithmetic, args.verbosity,
+            args.lot_matching, args.corporate_actions, args.stats, args.rate_tables,
+        )
+        return
+    run_arguments = dict(
+        output_filename=args.output,
+        other_costs_filename=args.other_costs,
+        rates_cache_filename=args.rates_cache,
+        rate_tables_directory=args.rate_tables,
+        columnar=args.columnar,
+        processes=args.processes,
+        arithmetic=args.arithmetic,
+        verbosity=args.verbosity,
+        lot_matching_strategy=args.lot_matching,
+        load_checkpoint_filename=args.load_checkpoint,
+        save_checkpoint_filename=args.save_checkpoint,
+        instrumentation_filename=args.stats,
+        ledger_filename=args.ledger,
+        ledger_format=args.ledger_format,
+        corporate_actions_filename=args.corporate_actions,
+        pipelined=args.pipelined,
+        parse_cache_directory=args.parse_cache,
+    )
+    if args.watch:
+        if args.pipelined:
+            logging.error('--watch processes again only changed statements and groups, it can not be used with --pipelined')
+            return
+        try:
+            watch(args.statements, args.watch_interval, **run_arguments)
+        except KeyboardInterrupt:
+            pass
+        return
+    result, other_costs = run(args.statements, **run_arguments)
+    if args.what_if:
+        run_what_if(result, other_costs, args.what_if, args.what_if_date, args.what_if_rank)
+
+
+if __name__ == '__main__':
+    main()
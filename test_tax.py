@@ -0,0 +1,108 @@
+import decimal
+import unittest
+
+import tax
+
+
+# (type, date, amount, quantity, rate), amounts and quantities as in statement lines
+STATEMENT = [
+    ('BUY', '2020-01-06', '423.27', '0.30498472', '3.8213'),
+    ('BUY', '2020-01-10', '1,417.72', '0.99155126', '3.8129'),
+    ('DIV', '2020-02-03', '1.92', '0', '3.9218'),
+    ('DIVNRA', '2020-02-03', '(0.29)', '0', '3.9218'),
+    ('SELL', '2020-03-02', '712.45', '-0.5', '3.9221'),
+    ('BUY', '2020-03-16', '950.10', '0.83313321', '4.1044'),
+    ('SELL', '2020-06-01', '1,606.66', '-1.12345678', '3.9850'),
+]
+# sell listed before the buy it is matched with, partial lots and sells of more stocks than were bought
+UNORDERED_STATEMENT = [
+    ('SELL', '2020-02-03', '300.00', '-2', '3.9218'),
+    ('BUY', '2020-01-06', '450.00', '3', '3.8213'),
+    ('BUY', '2020-01-10', '800.00', '5', '3.8129'),
+    ('SELL', '2020-03-02', '1,230.50', '-4.5', '3.9221'),
+    ('DIV', '2020-03-16', '2.10', '0', '4.1044'),
+    ('BUY', '2020-04-01', '120.00', '0.75', '4.1621'),
+    ('SELL', '2020-06-01', '700.00', '-3.25', '3.9850'),
+    ('SELL', '2020-07-01', '99.99', '-0.5', '3.7404'),
+]
+
+
+def get_transactions(statement=STATEMENT):
+    transactions = []
+    for transaction_type, transaction_date, amount, quantity, rate in statement:
+        transaction = tax.Transaction('GOOGL', 'GOOGL: ALPHABET INC', transaction_type, transaction_date, amount, quantity)
+        transaction.usd_price_in_given_date = decimal.Decimal(rate)
+        transaction.count_pln_value()
+        transactions.append(transaction)
+    return transactions
+
+
+def get_nested_scan_result(transactions):
+    """income, cost and stocks_left as counted before lot matchers, every sell scans all buys from the first one"""
+    quantities = [transaction.quantity_of_stocks for transaction in transactions]
+    income = cost = decimal.Decimal(0)
+    for sell_index, sell in enumerate(transactions):
+        if sell.transaction_type != 'SELL':
+            continue
+        amount_to_subtract = abs(sell.quantity_of_stocks)
+        for buy_index, buy in enumerate(transactions):
+            if buy.transaction_type != 'BUY' or quantities[buy_index] == 0:
+                continue
+            diff = quantities[buy_index] - amount_to_subtract
+            if diff < 0:
+                stocks_amount = quantities[buy_index]
+                amount_to_subtract = -diff
+                quantities[sell_index] = diff
+                quantities[buy_index] = 0
+            else:
+                stocks_amount = amount_to_subtract
+                quantities[sell_index] = 0
+                quantities[buy_index] = diff
+            income += sell.get_value_pln_for_given_amount_of_stocks(stocks_amount)
+            cost += buy.get_value_pln_for_given_amount_of_stocks(stocks_amount)
+            if diff >= 0:
+                break
+    return {'income': income, 'cost': cost, 'stocks_left': sum(quantities)}
+
+
+def get_scaled_transactions(statement=STATEMENT):
+    """Transactions with values scaled when parsed and filled with rates, as fixed point arithmetic gets them"""
+    transactions = get_transactions(statement)
+    for transaction in transactions:
+        transaction.scaled_quantity = tax.get_scaled_integer(transaction.quantity_of_stocks, tax.QUANTITY_SCALE)
+        transaction.scaled_value = tax.get_scaled_integer(transaction.value_usd, tax.VALUE_SCALE)
+        transaction.scaled_rate = tax.get_scaled_integer(transaction.usd_price_in_given_date, tax.RATE_SCALE)
+    return transactions
+
+
+class LotMatchingTest(unittest.TestCase):
+
+    def test_results_are_the_same_as_nested_scan(self):
+        for statement in (STATEMENT, UNORDERED_STATEMENT):
+            expected = get_nested_scan_result(get_transactions(statement))
+            result, _ = tax.get_processed_single_group('GOOGL', get_transactions(statement))
+            for key, value in expected.items():
+                with self.subTest(key=key):
+                    self.assertEqual(result[key], value)
+
+    def test_lot_matcher_is_abstract(self):
+        with self.assertRaises(TypeError):
+            tax.LotMatcher()
+
+
+class FixedPointTest(unittest.TestCase):
+
+    def test_fixed_point_results_are_the_same_as_decimal(self):
+        for statement in (STATEMENT, UNORDERED_STATEMENT):
+            expected, _ = tax.get_processed_single_group('GOOGL', get_transactions(statement))
+            for arithmetic in ('fixed_point', 'fixed_point_checked'):
+                for get_statement_transactions in (get_transactions, get_scaled_transactions):
+                    result, _ = tax.GROUP_PROCESSORS[arithmetic]('GOOGL', get_statement_transactions(statement))
+                    for key in tax.FIXED_POINT_CHECKED_KEYS:
+                        with self.subTest(arithmetic=arithmetic, scaled=get_statement_transactions is get_scaled_transactions, key=key):
+                            self.assertLess(abs(result[key] - expected[key]), tax.FIXED_POINT_TOLERANCE)
+                    self.assertEqual(result['lots_matched'], expected['lots_matched'])
+
+
+if __name__ == '__main__':
+    unittest.main()